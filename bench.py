@@ -0,0 +1,853 @@
+#!/usr/bin/python2.7
+# coding: utf-8
+#
+# Copyright (c) 2012, Johan Förberg <johan@forberg.se>.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmarks for DriveFS against a fake, in-process Drive."""
+
+import os
+import re
+import copy
+import random
+import resource
+import time
+import threading
+import argparse
+import shutil
+import sys
+import json
+import collections
+import tempfile
+import urlparse
+import ctypes
+import socket
+import BaseHTTPServer
+import SocketServer
+
+import drivefs
+import fakedrive
+from drivefs import MBYTES
+from fakedrive import make_feed, feed_page
+
+class FakeClient:
+    additional_headers = {}
+
+class FakePool(drivefs.ConnectionPool):
+    """Stand-in for the connection pool, serving zeroes after a delay."""
+    def __init__(self, sizes, latency, bandwidth):
+        drivefs.ConnectionPool.__init__(self)
+        self.sizes = sizes
+        self.latency = latency     # Seconds per request
+        self.bandwidth = bandwidth # Bytes per second and request
+        self.fetched = 0 # Bytes served
+        self.lock = threading.Lock()
+        self.sessions = {} # Upload URL -> [resource id, bytes, size]
+        self.sent = 0 # Bytes uploaded, including lost ones
+        self.failrate = 0 # Chance of an upload request failing midway
+
+    def request(self, method, url, headers={}, body=None):
+        if url.startswith(drivefs.UPLOAD_URL):
+            return self.start_upload(url, headers)
+        if url in self.sessions:
+            return self.upload(url, headers, body)
+        if url.startswith(drivefs.CHANGES_URL):
+            return 200, {}, make_feed([]) # Nothing ever changes.
+        if url.startswith(drivefs.DOCS_SERVER):
+            return 200, {}, feed_page(url, self.sizes)
+        m = re.match(r'bytes=(\d+)-(\d+)', headers['Range'])
+        n = int(m.group(2)) - int(m.group(1)) + 1
+        with self.lock:
+            self.fetched += n
+        time.sleep(self.latency + float(n) / self.bandwidth)
+        return 206, {}, '\0' * n
+
+    def start_upload(self, url, headers):
+        rid = url.split('?')[0][len(drivefs.UPLOAD_URL) + 1:]
+        with self.lock:
+            session = 'http://fake/upload/%d' % len(self.sessions)
+            rid = urlparse.unquote(rid) or 'file:%d' % len(self.sizes)
+            if not rid.startswith('file:'):
+                return 404, {}, ''
+            self.sessions[session] = [rid, 0,
+                    int(headers['X-Upload-Content-Length'])]
+        return 200, {'location': session}, ''
+
+    def upload(self, session, headers, body):
+        """Take a chunk, dropping the connection partway now and then."""
+        s = self.sessions[session]
+        time.sleep(self.latency + float(len(body)) / self.bandwidth)
+        m = re.match(r'bytes (\d+)-\d+/', headers['Content-Range'])
+        if m:
+            n = len(body)
+            if random.random() < self.failrate:
+                n = random.randrange(n)
+            with self.lock:
+                self.sent += n
+            if int(m.group(1)) == s[1]:
+                # What was saved: whole 256 KB units, or all that is left
+                saved = n
+                if s[1] + n < s[2]:
+                    saved -= n % (256 * drivefs.KBYTES)
+                s[1] += saved
+            if n < len(body):
+                raise socket.error(104, 'Connection reset by peer')
+        if s[1] < s[2]:
+            h = {'range': 'bytes=0-%d' % (s[1] - 1)} if s[1] else {}
+            return 308, h, ''
+        n = int(s[0][5:])
+        return 201, {}, make_feed([0] * n + [s[2]], n)
+
+class FakeEventPool(FakePool):
+    """A FakePool standing in for an EventPool, with submit()."""
+    def submit(self, method, url, headers={}, body=None):
+        """Serve the request on a thread of its own; return a Future."""
+        future = drivefs.Future()
+        def serve():
+            try:
+                future.set_result(self.request(method, url, headers, body))
+            except Exception as err:
+                future.set_exception(err)
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+        return future
+
+class FakeDriveFS(drivefs.DriveFS):
+    """A DriveFS talking to a FakePool instead of Google."""
+    def __init__(self, sizes, latency=0.05, bandwidth=20 * MBYTES, **kw):
+        pool = FakeEventPool if kw.get('backend') == 'events' else FakePool
+        self.fake = pool(sizes, latency, bandwidth)
+        drivefs.DriveFS.__init__(self, 'bench@example.com', '', **kw)
+
+    def login(self, email, password):
+        self.realpool = self.pool
+        self.fake.metrics = self.pool.metrics
+        self.client = FakeClient()
+        self.token = 'fake'
+        self.pool = self.fake
+        self.online.set()
+
+class ZeroHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers range requests with zeroes, after the server's latency."""
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    def do_GET(self):
+        m = re.match(r'bytes=(\d+)-(\d+)', self.headers['Range'])
+        n = int(m.group(2)) - int(m.group(1)) + 1
+        time.sleep(self.server.latency)
+        self.send_response(206)
+        self.send_header('Content-Length', str(n))
+        self.end_headers()
+        self.wfile.write('\0' * n)
+
+    def log_message(self, *args):
+        pass
+
+class ZeroServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server for content, so real sockets are used."""
+    daemon_threads = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ZeroHandler)
+        self.latency = latency
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+def read_file(fs, path, blksize=65536):
+    """Read the file at path through the FUSE operations, like cat."""
+    fh = fs('open', path, os.O_RDONLY)
+    offset = 0
+    while True:
+        data = fs('read', path, blksize, offset, fh)
+        if not data:
+            break
+        offset += len(data)
+    fs('release', path, fh)
+    return offset
+
+def read_files(fs, paths, blksize=65536):
+    """Read the files at paths at once, on a thread each. Raises the
+    first error, should any read fail."""
+    errors = []
+    def read(path):
+        try:
+            read_file(fs, path, blksize)
+        except Exception as err:
+            errors.append(err)
+    threads = [threading.Thread(target=read, args=(path,))
+               for path in paths]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    if errors:
+        raise errors[0]
+
+def bench_threads(args):
+    """Aggregate throughput of concurrent readers of separate files."""
+    print '%8s %10s %10s' % ('threads', 'seconds', 'MB/s')
+    n = 1
+    while n <= args.max_threads:
+        fs = FakeDriveFS([args.size * MBYTES] * n, args.latency,
+                         args.bandwidth * MBYTES,
+                         readahead=0)
+        fs.walker.join()
+        t = time.time()
+        read_files(fs, [u'/file%d' % i for i in xrange(n)])
+        t = time.time() - t
+        print '%8d %10.2f %10.1f' % (n, t, n * args.size / t)
+        n *= 2
+
+def bench_backends(args):
+    """Concurrent readers over local HTTP, with each network backend."""
+    server = ZeroServer(args.latency)
+    print '%8s %8s %10s %10s' % ('backend', 'readers', 'MB/s', 'requests')
+    for backend in ('threads', 'events'):
+        fs = FakeDriveFS([args.size * MBYTES] * args.readers,
+                         readahead=args.readahead, sync_interval=0,
+                         poolsize=args.pool_size, backend=backend)
+        fs.walker.join()
+        for f in fs.tree.root.children.values():
+            f.src = server.url + f.src.rsplit('/', 1)[1]
+        fs.pool = fs.realpool # The listing is fake, the content is not.
+        t = time.time()
+        read_files(fs, [u'/file%d' % i for i in xrange(args.readers)],
+                   MBYTES)
+        t = time.time() - t
+        print '%8s %8d %10.1f %10d' % (backend, args.readers,
+                                       args.readers * args.size / t,
+                                       fs.pool.stats()['requests'])
+
+def bench_segments(args):
+    """Throughput of one cold sequential reader, by segment settings."""
+    print '%8s %10s %10s' % ('segment', 'downloads', 'MB/s')
+    for segsize, downloads in ((0, 1), (4096, 8), (1024, 8), (1024, 16),
+                               (512, 32)):
+        fs = FakeDriveFS([args.size * MBYTES], args.latency,
+                         args.bandwidth * MBYTES, sync_interval=0,
+                         segsize=segsize * drivefs.KBYTES,
+                         downloads=downloads)
+        fs.walker.join()
+        t = time.time()
+        read_file(fs, u'/file0', 128 * drivefs.KBYTES)
+        print '%7dk %10d %10.1f' % (segsize, downloads,
+                                    args.size / (time.time() - t))
+
+def bench_uploads(args):
+    """Upload throughput and bytes resent, with requests failing."""
+    print '%8s %8s %10s %10s' % ('chunk', 'uploads', 'MB/s', 'resent %')
+    for upchunk, uploads in ((8192, 1), (8192, 4), (2048, 4), (512, 4)):
+        fs = FakeDriveFS([args.size * MBYTES] * args.files, args.latency,
+                         args.bandwidth * MBYTES, sync_interval=0, rw=True,
+                         upchunk=upchunk * drivefs.KBYTES, uploads=uploads,
+                         stagedir=tempfile.mkdtemp())
+        fs.walker.join()
+        fs.pool.failrate = args.failrate
+        fhs = []
+        for i in xrange(args.files):
+            path = u'/file%d' % i
+            fh = fs('open', path, os.O_WRONLY)
+            fs('write', path, 'x', 0, fh)
+            fhs.append((path, fh))
+            # Download the rest of it now; only the upload is timed.
+            f = fs.getfile(path)
+            f.fill(f.staging)
+        t = time.time()
+        for path, fh in fhs:
+            fs('flush', path, fh)
+        for path, fh in fhs:
+            fs('fsync', path, 0, fh)
+        elapsed = time.time() - t
+        total = args.files * args.size * MBYTES
+        print '%7dk %8d %10.1f %10.1f' % (upchunk, uploads,
+                total / elapsed / MBYTES,
+                100.0 * (fs.pool.sent - total) / total)
+        for path, fh in fhs:
+            fs('release', path, fh)
+        shutil.rmtree(fs.stagedir)
+
+def bench_stats(args):
+    """Cost of the stats per call, off and on, against getattr."""
+    print '%8s %12s' % ('stats', 'getattr us')
+    for stats in (False, True):
+        fs = FakeDriveFS([0], sync_interval=0, stats=stats)
+        fs.walker.join()
+        fs.getattr = lambda path, fh: {} # Only the call itself is timed.
+        t = time.time()
+        for i in xrange(args.calls):
+            fs('getattr', u'/file0', None)
+        print '%8s %12.3f' % (stats and 'on' or 'off',
+                              (time.time() - t) * 1e6 / args.calls)
+
+def timed(results, name, n, unit, fn, *args):
+    """Run fn(*args), which does n of unit, and record the rate."""
+    t = time.time()
+    errors = fn(*args)
+    elapsed = time.time() - t
+    results[name] = collections.OrderedDict([
+        (unit, n), ('seconds', round(elapsed, 4)),
+        (unit + '_per_s', round(n / elapsed, 1)), ('errors', errors)])
+
+def check_reads(fs, path, reads, blksize):
+    """Read the (offset, size) pairs of reads; return how many were
+    wrong."""
+    fh = fs('open', path, os.O_RDONLY)
+    errors = 0
+    for offset, size in reads:
+        data = fs('read', path, size, offset, fh)
+        errors += data != fakedrive.content(offset, offset + len(data)) or \
+                  not data
+    fs('release', path, fh)
+    return errors
+
+def upload_file(fs, drive, path, size, blksize):
+    """Write a new file of size bytes and wait until it is on the server;
+    return 1 if the server got it wrong."""
+    data = fakedrive.content(0, size)
+    fh = fs('create', path, 0644)
+    for offset in xrange(0, size, blksize):
+        fs('write', path, data[offset:offset + blksize], offset, fh)
+    fs('fsync', path, 0, fh)
+    fs('release', path, fh)
+    got = drive.files.get(len(drive.sizes) - 1, '')
+    return int(got != data)
+
+def list_tree(fs):
+    """Like ls -lR: list the root and stat every name in it."""
+    errors = 0
+    for name in fs('readdir', u'/', None)[2:]:
+        errors += 'st_size' not in fs('getattr', u'/' + name, None)
+    return errors
+
+def bench_suite(args):
+    """Standard workloads against a local fake Drive, as JSON."""
+    big = args.size * MBYTES
+    small = args.small_size * drivefs.KBYTES
+    # One file to read sequentially, one to read at random, then the
+    # small ones and empty ones to fill the listing.
+    sizes = [big, big] + [small] * args.small_files
+    sizes += [0] * (args.files - len(sizes))
+    drive = fakedrive.FakeDrive(sizes, args.latency,
+                                args.bandwidth * MBYTES,
+                                not args.ignore_range, 0,
+                                args.failrate).start()
+    drivefs.use_server(drive.url)
+    results = collections.OrderedDict()
+    box = []
+    def walk():
+        box.append(drivefs.DriveFS('bench@example.com', '', token='fake',
+                                   sync_interval=0, pagesize=args.page_size,
+                                   backend=args.backend, rw=True,
+                                   stagedir=tempfile.mkdtemp()))
+        box[0].walker.join()
+        return len(sizes) - len(box[0].tree.byid)
+    timed(results, 'walk', len(sizes), 'files', walk)
+    fs = box[0]
+    timed(results, 'ls_lR', len(sizes), 'files', list_tree, fs)
+    blksize = 128 * drivefs.KBYTES
+    reads = [(o, blksize) for o in xrange(0, big, blksize)]
+    timed(results, 'sequential_read', args.size, 'MB', check_reads, fs,
+          u'/file0', reads, blksize)
+    rnd = random.Random(1)
+    reads = [(rnd.randrange(big - 4096), 4096)
+             for i in xrange(args.random_reads)]
+    timed(results, 'random_read', args.random_reads, 'reads', check_reads,
+          fs, u'/file1', reads, 4096)
+    def small_files():
+        return sum(check_reads(fs, u'/file%d' % i, [(0, small)], small)
+                   for i in xrange(2, args.small_files + 2))
+    timed(results, 'small_files', args.small_files, 'files', small_files)
+    timed(results, 'upload', args.size, 'MB', upload_file, fs, drive,
+          u'/upload', big, blksize)
+    shutil.rmtree(fs.stagedir)
+    results['server'] = {'requests': drive.requests, 'bytes': drive.sent}
+    config = dict((k, v) for k, v in vars(args).items() if k != 'func')
+    out = open(args.json, 'w') if args.json else sys.stdout
+    json.dump({'config': config, 'results': results}, out, indent=2)
+    out.write('\n')
+    drive.shutdown()
+
+def bench_hedging(args):
+    """Read latency with a slow tail and failures, hedging off and on."""
+    print '%8s %10s %10s %10s %8s %8s' % ('hedge', 'p50 ms', 'p99 ms',
+                                         'max ms', 'requests', 'errors')
+    for hedge in (False, True):
+        drive = fakedrive.FakeDrive([args.blksize] * args.reads,
+                                    args.latency, 0, True, 0,
+                                    args.failrate, args.slowrate,
+                                    args.slow).start()
+        drivefs.use_server(drive.url)
+        fs = drivefs.DriveFS('bench@example.com', '', token='fake',
+                             sync_interval=0, readahead=0,
+                             backend=args.backend, hedge=hedge)
+        fs.walker.join()
+        times = []
+        errors = 0
+        # Every file is read once, so every read goes to the server.
+        for i in xrange(args.reads):
+            t = time.time()
+            try:
+                errors += check_reads(fs, u'/file%d' % i,
+                                      [(0, args.blksize)], args.blksize)
+            except drivefs.fuse.FuseOSError:
+                errors += 1
+            times.append(time.time() - t)
+        times.sort()
+        print '%8s %10.1f %10.1f %10.1f %8d %8d' % (hedge and 'on' or 'off',
+                times[len(times) // 2] * 1e3,
+                times[len(times) * 99 // 100] * 1e3, times[-1] * 1e3,
+                drive.requests, errors)
+        drive.shutdown()
+
+def bench_priority(args):
+    """Read latency while warming in the background, with the scheduler's
+    limits off and on."""
+    print '%8s %10s %10s %10s %10s' % ('limits', 'p50 ms', 'p99 ms',
+                                       'max ms', 'warm MB/s')
+    big = args.size * MBYTES
+    sizes = [big] * args.bulk + [args.blksize] * args.reads
+    for limits in ((0, 0, 0, 0), drivefs.IO_LIMITS):
+        drive = fakedrive.FakeDrive(sizes, args.latency,
+                                    args.bandwidth * MBYTES).start()
+        drivefs.use_server(drive.url)
+        fs = drivefs.DriveFS('bench@example.com', '', token='fake',
+                             sync_interval=0, readahead=0,
+                             backend=args.backend, iolimits=limits)
+        fs.walker.join()
+        files = [fs.getfile(u'/file%d' % i) for i in xrange(args.bulk)]
+        warmer = threading.Thread(target=fs.warm,
+                                  args=(files, 0, args.warmers,
+                                        open(os.devnull, 'w')))
+        warmer.daemon = True
+        warmer.start()
+        time.sleep(0.5) # Let it get going.
+        before, t0 = drive.sent, time.time()
+        times = []
+        for i in xrange(args.bulk, args.bulk + args.reads):
+            t = time.time()
+            check_reads(fs, u'/file%d' % i, [(0, args.blksize)],
+                        args.blksize)
+            times.append(time.time() - t)
+        rate = (drive.sent - before) / MBYTES / (time.time() - t0)
+        times.sort()
+        print '%8s %10.1f %10.1f %10.1f %10.1f' % (
+                ','.join(map(str, limits)), times[len(times) // 2] * 1e3,
+                times[len(times) * 99 // 100] * 1e3, times[-1] * 1e3, rate)
+        drive.shutdown()
+
+def bench_lookup(args):
+    """Cost of getattr as the root directory grows."""
+    print '%8s %12s %12s' % ('files', 'scan us', 'getattr us')
+    fs = FakeDriveFS([0], sync_interval=0)
+    fs.walker.join()
+    proto = fs.getfile(u'/file0')
+    n = 1000
+    while n <= args.max_files:
+        tree = drivefs.GDTree()
+        for i in xrange(n):
+            f = copy.copy(proto)
+            f.name = u'file%d' % i
+            tree.add(i, f)
+        fs.tree = tree
+        paths = [u'/file%d' % random.randrange(n) for i in xrange(1000)]
+        # What getfile used to do: compare against every name.
+        files = tree.root.children.values()
+        t = time.time()
+        for path in paths:
+            name = path[1:]
+            for f in files:
+                if f.name == name:
+                    break
+        scan = (time.time() - t) / len(paths)
+        t = time.time()
+        for path in paths:
+            fs.getattr(path, None)
+        t = (time.time() - t) / len(paths)
+        print '%8d %12.2f %12.2f' % (n, scan * 1e6, t * 1e6)
+        n *= 10
+
+def bench_listing(args):
+    """Upcalls and time of ls -l, cold and again while the kernel still
+    has the attributes from the first time."""
+    fs = FakeDriveFS([0] * args.files, sync_interval=0)
+    fs.walker.join()
+    calls = collections.Counter()
+    def call(op, *args):
+        calls[op] += 1
+        return fs(op, *args)
+    def ls_l(cached):
+        # Libfuse 2 has no readdirplus: the kernel looks up every name
+        # whose attributes it does not have.
+        calls.clear()
+        t = time.time()
+        for name in call('readdir', u'/', None)[2:]:
+            path = u'/' + name
+            if path not in cached:
+                cached[path] = call('getattr', path, None)
+        return time.time() - t
+    print '%8s %8s %10s %10s %10s' % ('files', 'ls -l', 'readdir',
+                                      'getattr', 'ms')
+    cached = {}
+    for run in ('cold', 'cached'):
+        elapsed = ls_l(cached)
+        print '%8d %8s %10d %10d %10.1f' % (args.files, run,
+                calls['readdir'], calls['getattr'], elapsed * 1e3)
+
+def shared_read(args, dedup):
+    """Read one file from several threads at once; return (MB, seconds)."""
+    fs = FakeDriveFS([args.size * MBYTES], args.latency,
+                     args.bandwidth * MBYTES, readahead=0, sync_interval=0)
+    fs.walker.join()
+    if not dedup: # Every reader downloads what it misses, as before.
+        fs.prefetcher.claim = lambda f, index, steal=False: True
+        fs.prefetcher.done = lambda f, index: None
+    t = time.time()
+    read_files(fs, [u'/file0'] * args.readers, 1 * MBYTES)
+    return float(fs.fake.fetched) / MBYTES, time.time() - t
+
+def bench_shared(args):
+    """Bytes downloaded when several handles read the same file."""
+    old = shared_read(args, False)
+    new = shared_read(args, True)
+    print '%8s %12s %10s %12s %10s' % ('readers', 'before MB', 'seconds',
+                                       'after MB', 'seconds')
+    print '%8d %12.0f %10.2f %12.0f %10.2f' % ((args.readers,) + old + new)
+
+def legacy_fuse_read(fs, path, buf, size, offset, fh):
+    """FUSE.read as it was: slice, copy to a new buffer, then memmove."""
+    ret = fs('read', path, size, offset, fh)
+    if not ret: return 0
+    data = ctypes.create_string_buffer(ret[:size], size)
+    ctypes.memmove(buf, data, size)
+    return size
+
+def bench_copies(args):
+    """Throughput of cached reads through fuse.FUSE.read."""
+    import fuse
+    size = args.size * MBYTES
+    fs = FakeDriveFS([size], sync_interval=0, readahead=0,
+                     cachesize=2 * size)
+    fs.walker.join()
+    read_file(fs, u'/file0') # Warm the cache.
+    fh = fs('open', u'/file0', os.O_RDONLY)
+    ops = fuse.FUSE.__new__(fuse.FUSE) # Just the glue, without mounting.
+    ops.operations, ops.raw_fi, ops.encoding = fs, False, 'utf-8'
+    fip = ctypes.pointer(fuse.fuse_file_info(fh=fh))
+    raw = (ctypes.c_byte * args.blksize)()
+    buf = ctypes.cast(raw, ctypes.POINTER(ctypes.c_byte))
+    def run(read):
+        t = time.time()
+        for i in xrange(args.rounds):
+            offset = 0
+            while offset < size:
+                offset += read(buf, args.blksize, offset)
+        return args.rounds * args.size / (time.time() - t)
+    old = run(lambda buf, n, off:
+              legacy_fuse_read(fs, u'/file0', buf, n, off, fh))
+    new = run(lambda buf, n, off: ops.read('/file0', buf, n, off, fip))
+    fs('release', u'/file0', fh)
+    print '%8s %12s %12s' % ('blksize', 'before MB/s', 'after MB/s')
+    print '%8d %12.0f %12.0f' % (args.blksize, old, new)
+
+class LegacyFile:
+    """A GDFile as it was before __slots__, to compare against."""
+    def __init__(self, rec, fs):
+        self.name, self.uri, self.src, self.version = rec[:4]
+        self.stat = {
+            'st_ctime': rec[5], 'st_mtime': rec[6], 'st_atime': rec[7],
+            'st_uid': os.getuid(), 'st_gid': os.getgid(),
+            'st_mode': drivefs.GDFile.mode, 'st_nlink': 1,
+            'st_size': rec[4], 'st_blksize': 65536}
+        self.is_doc = False
+        self.is_open = False
+        self.lock = threading.Lock()
+        self.fs = fs
+
+def synthetic_record(n):
+    """Return a GDFile record that looks like a real one."""
+    return (u'Document %d.pdf' % n,
+            'https://docs.google.com/feeds/id/file%%3A0B%026dabcdefghij' % n,
+            'https://doc-0s-bc-docs.googleusercontent.com/docs/securesc/'
+            'ha0ro937gcuc7l7deffksulhg5h7mbp1/%026d/1337630400000/'
+            '01234567890123456789/*/0B%026dabcdefghij?h=1234&e=download'
+            % (n, n), '2012-05-22T19:07:06.%03dZ' % (n % 1000),
+            n * 1000 + 17, 1337713626 + n, 1337713626 + 2 * n,
+            1337713626 + 3 * n)
+
+def rss():
+    """Return the resident set size of this process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def bytes_per_node(make, n):
+    """Build n nodes with make(record) in a child; return bytes/node.
+
+    The records are built first, so their strings are not counted."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        recs = [synthetic_record(i) for i in xrange(n)]
+        before = rss()
+        nodes = [make(rec) for rec in recs]
+        os.write(w, str(float(rss() - before) / n))
+        os._exit(0)
+    os.close(w)
+    os.waitpid(pid, 0)
+    return float(os.read(r, 64))
+
+def legacy_time(timestr):
+    """gdtime_to_ctime as it was, with a strptime per call."""
+    t = time.strptime(timestr[0:timestr.find('.')], '%Y-%m-%dT%H:%M:%S')
+    return int(time.mktime(t))
+
+def legacy_parse(data):
+    """Build the fields of a GDFile per entry the way it used to be done."""
+    from gdata.docs import DocumentListFeedFromString
+    nodes = []
+    for e in DocumentListFeedFromString(data).entry:
+        # Once in get_filesize and once more in GDFile.__init__
+        for i in xrange(2):
+            size = int(re.search(r':quotaBytesUsed.*>(\d+)</',
+                                 e.ToString()).groups()[0])
+        nodes.append((e.title.text.decode('utf-8'), e.id.text,
+                      e.content.src, e.updated.text, size,
+                      legacy_time(e.published.text),
+                      legacy_time(e.updated.text),
+                      legacy_time(e.lastViewed.text)))
+    return nodes
+
+def bench_parse(args):
+    """Entries per second turned into tree nodes, before and after."""
+    if args.feed:
+        with open(args.feed) as f:
+            data = f.read()
+    else:
+        data = make_feed([random.randrange(1 << 30)
+                          for i in xrange(args.entries)])
+    fs = object()
+    t = time.time()
+    n = len(legacy_parse(data))
+    old = time.time() - t
+    t = time.time()
+    entries, _, _ = drivefs.parse_feed(data)
+    nodes = [drivefs.GDFile(e, fs) for e in entries]
+    new = time.time() - t
+    print '%8s %12s %12s' % ('entries', 'before/s', 'after/s')
+    print '%8d %12.0f %12.0f' % (n, n / old, len(nodes) / new)
+
+def anon_rss():
+    """Return the anonymous (heap) part of the resident set in bytes."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+
+def legacy_lookup(self, index):
+    """GDFile.lookup as it was, copying disk chunks into memory."""
+    data = self.fs.chunks.get((self.uri, index))
+    if data is None and self.fs.disk:
+        data = self.fs.disk.get(self.uri, self.version, index)
+        if data is not None:
+            data = str(data)
+            self.fs.chunks.put((self.uri, index), data)
+    return data
+
+def heap_growth(args, cachedir, legacy):
+    """Read every file with all of them open; return (heap bytes, MB/s)."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        if legacy:
+            drivefs.GDFile.lookup = legacy_lookup
+        fs = FakeDriveFS([args.size * MBYTES] * args.files, sync_interval=0,
+                         readahead=0, cachedir=cachedir)
+        fs.walker.join()
+        paths = [u'/file%d' % i for i in xrange(args.files)]
+        fhs = [fs('open', path, os.O_RDONLY) for path in paths]
+        before = anon_rss()
+        t = time.time()
+        for path, fh in zip(paths, fhs):
+            offset = 0
+            while True:
+                n = len(fs('read', path, 1 * MBYTES, offset, fh))
+                if not n:
+                    break
+                offset += n
+        t = time.time() - t
+        os.write(w, '%d %f' % (anon_rss() - before,
+                               args.files * args.size / t))
+        os._exit(0)
+    os.close(w)
+    os.waitpid(pid, 0)
+    heap, rate = os.read(r, 64).split()
+    return int(heap), float(rate)
+
+def bench_mapped(args):
+    """Heap growth reading from the disk cache with many files open."""
+    cachedir = tempfile.mkdtemp()
+    try:
+        # Fill the disk cache first.
+        fs = FakeDriveFS([args.size * MBYTES] * args.files, latency=0,
+                         bandwidth=1e12, sync_interval=0, cachedir=cachedir)
+        fs.walker.join()
+        for i in xrange(args.files):
+            read_file(fs, u'/file%d' % i)
+        fs.disk.close()
+        old = heap_growth(args, cachedir, True)
+        new = heap_growth(args, cachedir, False)
+    finally:
+        shutil.rmtree(cachedir)
+    print '%8s %12s %12s %12s %12s' % ('files', 'before MB', 'MB/s',
+                                       'after MB', 'MB/s')
+    print '%8d %12.1f %12.0f %12.1f %12.0f' % (args.files,
+            float(old[0]) / MBYTES, old[1], float(new[0]) / MBYTES, new[1])
+
+def bench_memory(args):
+    """Bytes per file of the tree, before and after __slots__."""
+    fs = object() # Stands in for the mount all files point at.
+    old = bytes_per_node(lambda rec: LegacyFile(rec, fs), args.files)
+    new = bytes_per_node(lambda rec: drivefs.GDFile.from_record(rec, fs),
+                         args.files)
+    print '%8s %12s %12s' % ('files', 'before B', 'after B')
+    print '%8d %12.0f %12.0f' % (args.files, old, new)
+
+if __name__ == '__main__':
+    drivefs.MY_DEBUG = False
+
+    parser = argparse.ArgumentParser(prog='bench')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds per fake request')
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        help='MB/s per fake request')
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser('threads', help=bench_threads.__doc__)
+    p.add_argument('--max-threads', type=int, default=16)
+    p.add_argument('--size', type=int, default=16, help='MB per file')
+    p.set_defaults(func=bench_threads)
+
+    p = sub.add_parser('backends', help=bench_backends.__doc__)
+    p.add_argument('--readers', type=int, default=4)
+    p.add_argument('--size', type=int, default=32, help='MB per file')
+    p.add_argument('--readahead', type=int, default=8)
+    p.add_argument('--pool-size', type=int, default=16)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser('segments', help=bench_segments.__doc__)
+    p.add_argument('--size', type=int, default=256, help='MB per file')
+    p.set_defaults(func=bench_segments)
+
+    p = sub.add_parser('uploads', help=bench_uploads.__doc__)
+    p.add_argument('--files', type=int, default=8)
+    p.add_argument('--size', type=int, default=32, help='MB per file')
+    p.add_argument('--failrate', type=float, default=0.1,
+                   help='chance of a request failing')
+    p.set_defaults(func=bench_uploads)
+
+    p = sub.add_parser('suite', help=bench_suite.__doc__)
+    p.add_argument('--files', type=int, default=20000,
+                   help='files in the listing')
+    p.add_argument('--size', type=int, default=64,
+                   help='MB of the file read sequentially and randomly')
+    p.add_argument('--random-reads', type=int, default=500)
+    p.add_argument('--small-files', type=int, default=500)
+    p.add_argument('--small-size', type=int, default=16, help='KB')
+    p.add_argument('--page-size', type=int, default=drivefs.PAGESIZE)
+    p.add_argument('--backend', choices=('threads', 'events'),
+                   default='threads')
+    p.add_argument('--ignore-range', action='store_true',
+                   help='have the server send whole files')
+    p.add_argument('--failrate', type=float, default=0,
+                   help='chance of a read or upload chunk failing')
+    p.add_argument('--json', metavar='FILE',
+                   help='where to write the results; default stdout')
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser('hedging', help=bench_hedging.__doc__)
+    p.add_argument('--reads', type=int, default=1000)
+    p.add_argument('--blksize', type=int, default=64 * 1024)
+    p.add_argument('--failrate', type=float, default=0,
+                   help='chance of a 503')
+    p.add_argument('--slowrate', type=float, default=0.03,
+                   help='chance of a request being held up')
+    p.add_argument('--slow', type=float, default=0.5,
+                   help='seconds to hold it up for')
+    p.add_argument('--backend', choices=('threads', 'events'),
+                   default='threads')
+    p.set_defaults(func=bench_hedging)
+
+    p = sub.add_parser('priority', help=bench_priority.__doc__)
+    p.add_argument('--bulk', type=int, default=64, help='files to warm')
+    p.add_argument('--size', type=int, default=16, help='MB per file')
+    p.add_argument('--warmers', type=int, default=drivefs.DOWNLOADS,
+                   help='threads warming')
+    p.add_argument('--reads', type=int, default=100)
+    p.add_argument('--blksize', type=int, default=64 * 1024)
+    p.add_argument('--backend', choices=('threads', 'events'),
+                   default='threads')
+    p.set_defaults(func=bench_priority)
+
+    p = sub.add_parser('stats', help=bench_stats.__doc__)
+    p.add_argument('--calls', type=int, default=200000)
+    p.set_defaults(func=bench_stats)
+
+    p = sub.add_parser('lookup', help=bench_lookup.__doc__)
+    p.add_argument('--max-files', type=int, default=100000)
+    p.set_defaults(func=bench_lookup)
+
+    p = sub.add_parser('listing', help=bench_listing.__doc__)
+    p.add_argument('--files', type=int, default=50000)
+    p.set_defaults(func=bench_listing)
+
+    p = sub.add_parser('shared', help=bench_shared.__doc__)
+    p.add_argument('--readers', type=int, default=8)
+    p.add_argument('--size', type=int, default=64, help='MB per file')
+    p.set_defaults(func=bench_shared)
+
+    p = sub.add_parser('copies', help=bench_copies.__doc__)
+    p.add_argument('--size', type=int, default=64, help='MB per file')
+    p.add_argument('--blksize', type=int, default=128 * 1024)
+    p.add_argument('--rounds', type=int, default=10)
+    p.set_defaults(func=bench_copies)
+
+    p = sub.add_parser('parse', help=bench_parse.__doc__)
+    p.add_argument('--entries', type=int, default=5000)
+    p.add_argument('--feed', help='parse a recorded feed page instead')
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser('mapped', help=bench_mapped.__doc__)
+    p.add_argument('--files', type=int, default=200)
+    p.add_argument('--size', type=int, default=8, help='MB per file')
+    p.set_defaults(func=bench_mapped)
+
+    p = sub.add_parser('memory', help=bench_memory.__doc__)
+    p.add_argument('--files', type=int, default=1000000)
+    p.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -26,16 +26,41 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import sys
+import re
 import posixpath
 import errno
 import os
 import time
-import re
+import calendar
 import stat
 import tempfile
 import httplib
 import urlparse
+import urllib
 import argparse
+import collections
+import threading
+import hashlib
+import copy
+import random
+import email.utils
+import logging
+import signal
+import json
+import itertools
+import Queue
+import socket
+import select
+import ssl
+import marshal
+import ctypes
+import mmap
+import zlib
+import fcntl
+import resource
+import fnmatch
+import cStringIO
+import xml.etree.cElementTree as etree
 
 import fuse 
 import gdata.service as gdata
@@ -45,39 +70,119 @@ __author__ = 'Johan Förberg <johan@forberg.se>'
 
 KBYTES  = 2**10
 MBYTES  = 2**20
+GBYTES  = 2**30
 
 APPNAME   = 'drivefs'
-MY_DEBUG   = True
+MY_DEBUG   = False # Whether debug messages are logged; see set_log_level()
 FUSE_DEBUG = False
 CODING     = 'utf-8'
-#CHUNKSIZE  = 4 * MBYTES # Size of a cache chunk.
-
-class GDBaseFile:
-    """Common superclass for GDDir and GDFile."""
-    def __init__(self, entry=None):
-        # entry == None means I am the root dir.
-        name  = entry.title.text if entry else '/'
-        self.name = name.decode(CODING)
-        self.stat = {
-            'st_ctime': 0,
-            'st_mtime': 0,
-            'st_atime': 0,
-            'st_uid':   os.getuid(),
-            'st_gid':   os.getgid(),
-            'st_mode':  (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH),
+CHUNKSIZE  = 4 * MBYTES   # Size of a cache chunk.
+CACHESIZE  = 256 * MBYTES # Memory budget for chunks, without a disk cache.
+DISKCACHESIZE = 4 * GBYTES # Default size cap of the on-disk cache.
+DISKCACHEDIR  = os.path.expanduser('~/.cache/' + APPNAME)
+EVICT_INTERVAL = 60 # Seconds between disk cache evictions.
+# Disk cache files kept mapped at once. Each mapping holds a file
+# descriptor, as do unmapped ones still being read from, so most are left
+# for connections and staging files.
+MAXMAPS = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+MAXMAPS = 256 if MAXMAPS == resource.RLIM_INFINITY else \
+          max(16, min(256, MAXMAPS // 8))
+READAHEAD_MAX  = 8  # Largest read-ahead window, in chunks.
+PREFETCH_THREADS = 4
+SEGMENTSIZE = 1 * MBYTES # Size of the parallel requests of a download.
+DOWNLOADS  = 8  # Segments downloaded at once.
+POOLSIZE   = 8  # Connections per host.
+TIMEOUT    = 60 # Seconds before a stalled connection is given up.
+RECVSIZE   = 256 * KBYTES # Bytes read from a socket at a time.
+DOCS_SERVER = 'https://docs.google.com'
+CHANGES_URL = DOCS_SERVER + '/feeds/default/private/changes'
+PAGESIZE   = 500 # Entries per page of the document list.
+SYNC_INTERVAL = 60 # Seconds between incremental syncs.
+ATTR_TIMEOUT = 60 # Seconds the kernel may cache attributes and names.
+CHANGES_HEADERS = {'GData-Version': '3.0'} # Changes are new in v3.
+SNAPSHOT_INTERVAL = 600 # Seconds between snapshots of the tree.
+SNAPSHOT_FORMAT = 1 # Bump when GDFile.record() changes.
+UPLOAD_URL = DOCS_SERVER + '/feeds/upload/create-session/default/private/full'
+UPLOAD_HEADERS = {'GData-Version': '3.0',
+                  'X-Upload-Content-Type': 'application/octet-stream'}
+UPLOADCHUNK = 8 * MBYTES # Bytes per PUT; a multiple of 512 KB.
+UPLOAD_THREADS = 2 # Files uploaded at once
+UPLOAD_DELAY = 2.0 # Seconds a truncate waits for a writer to upload it
+UPLOAD_RETRIES = 8 # Failures in a row before an upload gives up
+UPLOAD_BACKOFF = 1.0 # Seconds before the first retry, doubled for each
+# Failures worth another try: network trouble, or Google having a bad day.
+NETERRORS = (EnvironmentError, EOFError, httplib.HTTPException)
+RETRIES = 5 # Tries after the first, for requests failing on the way
+RETRY_BASE = 0.5 # Seconds; backoff is up to this times 2**failures
+RETRY_CAP = 30.0 # Seconds, at most, between tries
+DEADLINE = 120 # Seconds a request may take, retries and all
+HEDGE_PERCENTILE = 95 # Range requests slower than this get a duplicate
+HEDGE_SAMPLES = 200 # Latencies of range requests the percentile is of
+HEDGE_MIN = 0.05 # Seconds; never hedge sooner than this
+# Classes of requests for the Scheduler, most urgent first: reads someone
+# waits for, read-ahead, syncing the tree, and warming and uploads.
+FOREGROUND, READAHEAD, METADATA, BULK = range(4)
+IO_CLASSES = ('foreground', 'readahead', 'metadata', 'bulk')
+# Requests of each class at once, 0 for no limit. The background ones
+# leave connections free for reads.
+IO_LIMITS = (0, 4, 1, 2)
+STATS_PATH = u'/.drivefs-stats' # Virtual file with the stats, if enabled
+LOG_FORMAT = '%(asctime)s %(threadName)s %(levelname)s %(message)s'
+LOG_LEVELS = (logging.WARNING, logging.INFO, logging.DEBUG) # For SIGUSR1
+LOG_SAMPLE = 100 # Log 1 in this many of the busiest calls
+RINGSIZE = 10000 # Log records kept in memory, for SIGUSR2
+
+log = logging.getLogger(APPNAME)
+
+# Everything is owned by whoever mounted it.
+UID = os.getuid()
+GID = os.getgid()
+
+# XML namespaces of the feeds
+ATOM = '{http://www.w3.org/2005/Atom}'
+GD   = '{http://schemas.google.com/g/2005}'
+DOCS = '{http://schemas.google.com/docs/2007}'
+
+class FeedEntry(object):
+    """The parts of an entry in a document list or changes feed we use."""
+    __slots__ = ('id', 'rid', 'title', 'published', 'updated', 'viewed',
+                 'size', 'src', 'kind', 'changestamp', 'gone')
+
+    def __init__(self):
+        self.id = self.rid = self.title = self.src = self.kind = None
+        self.published = self.updated = self.viewed = None
+        self.size = 0
+        self.changestamp = None
+        self.gone = False # Deleted, or removed from our view.
+
+class GDBaseFile(object):
+    """Common superclass for GDDir and GDFile.
+
+    There may be millions of these, so they use __slots__ and build their
+    stat dicts only when asked."""
+    __slots__ = ('name',)
+    mode = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    size = ctime = mtime = atime = 0
+    is_doc = False # We don't handle docs for now.
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def stat(self):
+        """A stat(2)-like dict of my attributes."""
+        return {
+            'st_ctime': self.ctime,
+            'st_mtime': self.mtime,
+            'st_atime': self.atime,
+            'st_uid':   UID,
+            'st_gid':   GID,
+            'st_mode':  self.mode,
             'st_nlink': 1,
-            'st_size':  0,
+            'st_size':  self.size,
             # The blocksize affects the default buffer size for file reads
             'st_blksize': 65536
         }
-        # The id is a unique identifier which can be used to fetch the object
-        # from Google
-        self.uri = entry.id.text if entry \
-                else gdocs.DocumentQuery().ToUri() # Root element.
-        self.is_doc = False # We don't handle docs for now.
-
-    # Magic filesize getter.
-    size = property(lambda self: self.stat['st_size'])
 
     def __repr__(self):
         return '<%s %s at 0x%x>' % (self.__class__.__name__, 
@@ -85,59 +190,194 @@ class GDBaseFile:
 
 class GDDir(GDBaseFile):
     """Local representation of a Drive 'Category'."""
-    def __init__(self, entry=None, dirs=[], files=[]):
-        GDBaseFile.__init__(self, entry)
-        self.stat['st_mode'] |= (stat.S_IFDIR |
-                                 stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-        self.files = files
-        self.dirs  = dirs
+    __slots__ = ('children',)
+    mode = GDBaseFile.mode | (stat.S_IFDIR |
+                              stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def __init__(self, name=u'/'):
+        GDBaseFile.__init__(self, name)
+        self.children = {} # Name -> child file or dir
 
     def child(self, name):
         """Find and return the child file or dir named name."""
-        for d in self.dirs:
-            if d.name == name:
-                return d
-        for f in self.files:
-            if f.name == name:
-                return f
-        # No child was found
-        raise KeyError('Does not exist: %s/%s' % (self.name, name))
-        return None
+        try:
+            return self.children[name]
+        except KeyError:
+            raise KeyError('Does not exist: %s/%s' % (self.name, name))
+
+    def add(self, f):
+        """Add a child. Return False if the name is already taken."""
+        # Until names are mangled, the first file of a name wins.
+        return self.children.setdefault(f.name, f) is f
+
+    def remove(self, f):
+        """Remove a child. Return False if it was not visible."""
+        if self.children.get(f.name) is f:
+            del self.children[f.name]
+            return True
+        return False
+
+class GDTree(object):
+    """The files of a mount, indexed by path and by resource id.
+
+    Every lookup is a dict hit, however large the directories get."""
+    def __init__(self):
+        self.root = GDDir()
+        self.paths = {u'/': self.root}
+        self.byid = {}
+        self.hidden = {} # Name -> files behind the one going by it
+        self.lock = threading.Lock() # Taken by writers; lookups are atomic.
+
+    def lookup(self, path):
+        """Return the node at path (absolute), or None."""
+        return self.paths.get(path)
+
+    def add(self, rid, f):
+        """Add the file with resource id rid."""
+        with self.lock:
+            self.byid[rid] = f
+            self.show(f)
+
+    def remove(self, rid):
+        """Remove and return the file with resource id rid, or None."""
+        with self.lock:
+            f = self.byid.pop(rid, None)
+            if f and self.hide(f):
+                self.vacate(f.name)
+            return f
+
+    def rekey(self, old, new):
+        """Let the file with resource id old go by new from now on."""
+        with self.lock:
+            f = self.byid.pop(old)
+            # A sync may have seen it first, as a file of its own.
+            stale = self.byid.get(new)
+            if stale is not None and stale is not f and self.hide(stale):
+                self.vacate(stale.name)
+            self.byid[new] = f
+
+    def update(self, rid, new):
+        """Bring the file with resource id rid up to date with new."""
+        with self.lock:
+            f = self.byid.get(rid)
+            if f is None:
+                self.byid[rid] = f = new
+            name = f.name
+            self.hide(f)
+            f.update(new) # May rename it.
+            self.show(f)
+            self.vacate(name)
+
+    # The helpers below are called with the lock held.
+
+    def show(self, f):
+        """Give f its path, or hide it behind the file already there."""
+        if self.root.add(f):
+            self.paths[u'/' + f.name] = f
+        else:
+            self.hidden.setdefault(f.name, []).append(f)
+
+    def hide(self, f):
+        """Take f out of the paths, or out of the hidden files. Return
+        True if it had a path."""
+        if self.root.remove(f):
+            del self.paths[u'/' + f.name]
+            return True
+        hidden = self.hidden.get(f.name)
+        if hidden and f in hidden:
+            hidden.remove(f)
+            if not hidden:
+                del self.hidden[f.name]
+        return False
+
+    def vacate(self, name):
+        """Give a free name to the first file hidden behind it, if any."""
+        hidden = self.hidden.get(name)
+        if hidden and name not in self.root.children:
+            f = hidden.pop(0)
+            if not hidden:
+                del self.hidden[name]
+            self.show(f)
 
 class GDFile(GDBaseFile):
     """Local representation of a Drive file."""
-    def __init__(self, entry, client):
-        GDBaseFile.__init__(self, entry)
-        self.stat['st_ctime'] = gdtime_to_ctime(
-                entry.published.text  if entry.published  else 0)
-        self.stat['st_mtime'] = gdtime_to_ctime(
-                entry.updated.text  if entry.updated  else 0)
-        self.stat['st_atime'] = gdtime_to_ctime(
-                entry.lastViewed.text  if entry.lastViewed  else 0)
-        self.stat['st_mode'] |= stat.S_IFREG
-        self.stat['st_size']  = get_filesize(entry)
-        # Grepping filesize from XML representation (a shameless kludge)
-        try:
-            m = re.search(r':quotaBytesUsed.*>(\d+)</', entry.ToString())
-            self.stat['st_size'] = int(m.groups()[0])
-        except AttributeError: # No match
-            pass # stat['st_size'] == 0; set in superclass.
-        self.uri = entry.id.text
-        self.src = entry.content.src
-        self.cache = None
-        self.is_open = False
-        self.client = client
+    __slots__ = ('rid', 'uri', 'src', 'version', 'size', 'ctime', 'mtime',
+                 'atime', 'opens', 'staging', 'fs')
+    mode = GDBaseFile.mode | stat.S_IFREG
+
+    def __init__(self, entry, fs):
+        """Create a file from a FeedEntry."""
+        GDBaseFile.__init__(self, unicode(entry.title or u''))
+        self.ctime = gdtime_to_ctime(entry.published)
+        self.mtime = gdtime_to_ctime(entry.updated)
+        self.atime = gdtime_to_ctime(entry.viewed)
+        self.size  = entry.size
+        # The id is a unique identifier which can be used to fetch the object
+        # from Google
+        self.uri = entry.id
+        self.src = entry.src
+        # Cached content is only valid for this version of the file.
+        self.version = entry.updated
+        self.rid = resource_id(entry)
+        self.opens = 0 # Open handles
+        self.staging = None # Local changes not yet uploaded, if any
+        self.fs = fs # The mount I belong to.
+
+    def record(self):
+        """Return my metadata as a tuple of plain values."""
+        return (self.name, self.uri, self.src, self.version, self.size,
+                self.ctime, self.mtime, self.atime)
+
+    @classmethod
+    def from_record(cls, rec, fs, rid=None):
+        """Recreate a file from the output of record()."""
+        f = cls.__new__(cls)
+        (f.name, f.uri, f.src, f.version, f.size,
+         f.ctime, f.mtime, f.atime) = rec
+        f.rid = rid
+        f.opens = 0
+        f.staging = None
+        f.fs = fs
+        return f
+
+    @classmethod
+    def new(cls, name, fs):
+        """Create an empty file, which Google learns of when uploaded."""
+        now = int(time.time())
+        return cls.from_record((name, None, None, None, 0, now, now, now),
+                               fs, 'local:%d' % fs.fhs.next())
+
+    def update(self, other):
+        """Take over the metadata of other, a newer version of me."""
+        if other is self:
+            return
+        if self.staging is not None:
+            self.name = other.name # Local changes win until uploaded.
+            return
+        if other.version != self.version:
+            self.fs.chunks.discard(self.uri) # The disk cache checks itself.
+        (self.name, self.src, self.version, self.size,
+         self.ctime, self.mtime, self.atime) = \
+                (other.name, other.src, other.version, other.size,
+                 other.ctime, other.mtime, other.atime)
+
+    @property
+    def is_open(self):
+        return self.opens > 0
 
     def open(self):
-        """Open a Drive file for reading."""
-        if not self.is_open:
-            self.is_open = True
+        """Open a Drive file for reading. Every open needs a close."""
+        with self.fs.lock:
+            self.opens += 1
+        if self.fs.disk:
+            self.fs.disk.pin(self) # Not evicted while open.
 
     def close(self):
-        """Close a file and destroy its cache."""
-        if self.is_open:
-            self.cache = None # Clear the cache
-            self.is_open = False
+        """Close a file. Its chunks stay in the mount's cache."""
+        with self.fs.lock:
+            self.opens -= 1
+        if self.fs.disk:
+            self.fs.disk.unpin(self)
 
     def read(self, size=None, offset=0):
         """Read size bytes from offset and return as a string."""
@@ -145,46 +385,1881 @@ class GDFile(GDBaseFile):
             raise DriveFSError('%s is not open for reading!' % self.name)
         if size is None:
             size = self.size - offset
-        if not self.cache:
-            data = None
-            # It is not an error to request data beyond the end of the file.
-            if self.size == 0 or offset > self.size:
-                return ''
-            if offset + size > self.size:
-                size = self.size - offset
-            # The request fails unless Range is present, for unknown reasons.
-            headers = {'Range': 'bytes=%d-%d' % (offset, offset + size)}
-            try: 
-                data = self.client.Get(self.src, extra_headers=headers)
-                # Google API will raise an exception even if the request
-                # succeeds with status 206 (Partial Content), as intended.
-            except gdata.RequestError as err:
-                if err[0]['status'] == httplib.PARTIAL_CONTENT:
-                    data = err[0]['body'] # The data we were looking for.
-                else: 
-                    data = None
-                    raise # There was some other error.
-            self.cache = data
-
-        # We now have a cached copy of the file.
-        return self.cache[offset:size + offset]
+        st = self.staging
+        if st is not None:
+            self.fill(st, offset, offset + size)
+            return st.read(size, offset)
+        # It is not an error to request data beyond the end of the file.
+        if offset >= self.size or size <= 0:
+            return ''
+        end = min(offset + size, self.size)
+        first = offset // CHUNKSIZE
+        data = self.load(first, (end - 1) // CHUNKSIZE)
+        start = offset - first * CHUNKSIZE
+        if len(data) == 1: # The common case, avoid a join.
+            return data[0][start:start + end - offset]
+        return ''.join(map(str, data))[start:start + end - offset]
+
+    def readinto(self, buf, size, offset):
+        """Like read, but copy into the ctypes pointer buf instead.
+
+        Returns the number of bytes copied."""
+        if not self.is_open:
+            raise DriveFSError('%s is not open for reading!' % self.name)
+        st = self.staging
+        if st is not None:
+            self.fill(st, offset, offset + size)
+            data = st.read(size, offset)
+            ctypes.memmove(buf, data, len(data))
+            return len(data)
+        if offset >= self.size or size <= 0:
+            return 0
+        end = min(offset + size, self.size)
+        first = offset // CHUNKSIZE
+        pos = offset - first * CHUNKSIZE
+        dst = ctypes.addressof(buf.contents)
+        n = 0
+        # One copy per chunk, straight from the cached string.
+        for data in self.load(first, (end - 1) // CHUNKSIZE):
+            k = min(len(data) - pos, end - offset - n)
+            ctypes.memmove(dst + n, fuse.read_buffer(data)[0] + pos, k)
+            n += k
+            pos = 0
+        return n
+
+    def open_write(self, truncate=False):
+        """Open me for writing. Writes go to a local staging file, which
+        has my content unless truncate is set: it is filled in as it is
+        needed, so the open does not wait for the download."""
+        with self.fs.lock:
+            st = self.staging
+            new = st is None
+            if new:
+                st = Staging(self.fs.stagedir, self.fs.journal)
+                if not self.rid.startswith('local:'):
+                    st.base = self.record()
+                if not truncate and self.size:
+                    st.file.truncate(self.size) # Sparse until filled in
+                    st.limit = self.size
+                    st.missing = set(xrange((self.size - 1) // CHUNKSIZE
+                                            + 1))
+                self.staging = st
+            st.writers += 1
+        if new:
+            try:
+                self.fs.journal.update(st.key, rid=self.rid, name=self.name,
+                                       missing=sorted(st.missing),
+                                       limit=st.limit)
+            except:
+                with self.fs.lock:
+                    self.staging = None
+                st.discard()
+                raise
+        if truncate:
+            self.truncate(0)
+
+    def fill(self, st, start=0, end=None, whole=True):
+        """Fill in the chunks of staging file st overlapping [start, end),
+        or all of them, with my content on Drive; but for those the range
+        covers whole, unless whole is set."""
+        with st.lock:
+            if not st.missing:
+                return
+            gaps = st.gaps(start, st.limit if end is None else end, whole)
+        if gaps:
+            drive = GDFile.from_record(st.base, self.fs, self.rid)
+            for i in gaps:
+                st.fill(i, str(drive.load(i, i)[0]))
+
+    def close_write(self, upload=True):
+        """Close a handle opened with open_write, uploading any changes
+        unless upload is unset."""
+        st = self.staging
+        with self.fs.lock:
+            st.writers -= 1
+        if upload:
+            self.flush()
+
+    def write(self, data, offset):
+        """Write data at offset, to the staging file only."""
+        st = self.staging
+        self.fill(st, offset, offset + len(data), False)
+        st.write(data, offset)
+        self.size = max(self.size, offset + len(data))
+        self.mtime = int(time.time())
+        return len(data)
+
+    def truncate(self, length):
+        self.staging.truncate(length)
+        self.size = length
+        self.mtime = int(time.time())
+
+    def flush(self):
+        """Start uploading my changes, if there are any."""
+        st = self.staging
+        if st is None:
+            return
+        if st.dirty():
+            self.fs.uploader.submit(self)
+        else:
+            self.retire()
+
+    def fsync(self):
+        """Upload my changes and wait until Google has them."""
+        st = self.staging
+        if st is None:
+            return
+        gen = st.gen
+        self.flush()
+        st.wait(gen)
+
+    def upload(self):
+        """Upload my staged content, unless that has been done already."""
+        st = self.staging
+        if st is None:
+            return
+        with st.uploading: # One upload of a file at a time.
+            gen = st.gen
+            if st.uploaded >= gen:
+                return
+            try:
+                self.fill(st)
+                e = self.fs.upload(self, st, gen)
+            except Exception as err:
+                log.warning('upload of %r failed: %s', self.name, err)
+                st.finish(gen, err)
+                return
+            if self.rid.startswith('local:'):
+                self.fs.tree.rekey(self.rid, resource_id(e))
+                self.rid = resource_id(e)
+                self.uri = e.id
+                self.fs.journal.update(st.key, rid=self.rid)
+            self.src = e.src or self.src
+            self.version = e.updated
+            self.mtime = gdtime_to_ctime(e.updated) or self.mtime
+            st.finish(gen, None)
+        self.retire()
+
+    def retire(self):
+        """Drop the staging file once uploaded and closed, moving its
+        content to the cache."""
+        with self.fs.lock:
+            st = self.staging
+            if st is None or st.writers or st.dirty():
+                return
+            self.staging = None
+        if st.uploaded and self.version: # Changed, so cache the new version
+            self.fs.chunks.discard(self.uri)
+            try:
+                for i in xrange((self.size - 1) // CHUNKSIZE + 1):
+                    self.store(i, st.read(CHUNKSIZE, i * CHUNKSIZE))
+            except EnvironmentError:
+                pass # Only a cache
+        st.discard()
+
+    def load(self, first, last, prio=FOREGROUND):
+        """Return the list of chunks first..last, fetching missing ones.
+
+        A chunk is downloaded once, however many readers want it at the
+        same time: the others wait for it instead."""
+        inflight = self.fs.prefetcher
+        data = [self.lookup(i) for i in xrange(first, last + 1)]
+        stats = self.fs.stats
+        if stats is not None:
+            hits = len(data) - data.count(None)
+            stats.count('chunk_hits', hits)
+            stats.count('chunk_misses', len(data) - hits)
+        i = 0
+        while i < len(data):
+            if data[i] is not None:
+                i += 1
+                continue
+            # Fetch each run of missing chunks nobody else is fetching with
+            # a single request.
+            j = i
+            while j < len(data) and data[j] is None and \
+                    inflight.claim(self, first + j, prio < READAHEAD):
+                j += 1
+            if j == i:
+                # Wait for whoever is fetching it, with their requests
+                # as urgent as ours. Should they fail, the next round
+                # claims it for us.
+                start = (first + i) * CHUNKSIZE
+                self.fs.scheduler.promote(prio, self.src, start,
+                                          start + CHUNKSIZE)
+                inflight.wait(self, first + i)
+                data[i] = self.lookup(first + i)
+                continue
+            try:
+                start = (first + i) * CHUNKSIZE
+                buf = self.fetch(start,
+                                 min((first + j) * CHUNKSIZE, self.size),
+                                 prio)
+                for k in xrange(i, j):
+                    pos = (k - i) * CHUNKSIZE
+                    data[k] = buf[pos:pos + CHUNKSIZE]
+                    self.store(first + k, data[k])
+            finally:
+                for k in xrange(i, j):
+                    inflight.done(self, first + k)
+            i = j
+        return data
+
+    def lookup(self, index):
+        """Return a chunk from the disk or memory cache, or None.
+
+        Chunks from disk are buffers into a mapping of the cache file, so
+        they live in the page cache rather than our heap."""
+        if self.fs.disk:
+            return self.fs.disk.get(self.uri, self.version, index)
+        return self.fs.chunks.get((self.uri, index))
+
+    def cached(self, index):
+        """Whether chunk index is in the cache, without reading it."""
+        if self.fs.disk:
+            return self.fs.disk.has(self.uri, self.version, index)
+        return (self.uri, index) in self.fs.chunks
+
+    def store(self, index, data):
+        """Put a freshly downloaded chunk in the cache."""
+        if self.fs.disk:
+            self.fs.disk.put(self.uri, self.version, self.size, index, data)
+        else:
+            self.fs.chunks.put((self.uri, index), data)
+
+    def fetch(self, start, end, prio=FOREGROUND):
+        """Download the bytes in [start, end) from Google, as a request
+        of class prio.
+
+        Large ranges are split into segments, downloaded in parallel."""
+        segments = self.segments(start, end)
+        if len(segments) == 1:
+            return self.fetch_range(start, end, prio)
+        futures = [self.fetch_segment(s, e, prio) for s, e in segments]
+        # Each segment gives up by DEADLINE; so do we, should one hang.
+        return ''.join(gather(futures).result(DEADLINE))
+
+    def fetch_async(self, start, end, prio=FOREGROUND):
+        """Like fetch, but return a Future. Needs an EventPool."""
+        futures = [self.fetch_segment(s, e, prio)
+                   for s, e in self.segments(start, end)]
+        return gather(futures).then(''.join)
+
+    def segments(self, start, end):
+        """Split [start, end) into the ranges to request."""
+        size = self.fs.segsize
+        if not size:
+            return [(start, end)]
+        return [(s, min(s + size, end)) for s in xrange(start, end, size)]
+
+    def fetch_segment(self, start, end, prio=FOREGROUND):
+        """Start downloading [start, end); return a Future of the bytes."""
+        future = self.fs.submit('GET', self.src,
+                                self.range_headers(start, end), hedge=True,
+                                prio=prio)
+        return future.then(lambda resp: self.range_body(start, end, resp))
+
+    def fetch_range(self, start, end, prio=FOREGROUND):
+        """Download the bytes in [start, end) with a single request."""
+        resp = self.fs.request('GET', self.src,
+                               self.range_headers(start, end), hedge=True,
+                               prio=prio)
+        return self.range_body(start, end, resp)
+
+    def range_headers(self, start, end):
+        # The request fails unless Range is present, for unknown reasons.
+        return self.fs.headers({'Range': 'bytes=%d-%d' % (start, end - 1)})
+
+    def range_body(self, start, end, resp):
+        """Return the bytes in [start, end) of a response to a fetch."""
+        status, _, body = resp
+        if status == httplib.PARTIAL_CONTENT:
+            return body
+        elif status == httplib.OK: # Range ignored, we got the whole file.
+            return body[start:end]
+        raise HTTPError(status, self.src)
+
+class StatsFile(GDBaseFile):
+    """The virtual file showing the stats of a mount.
+
+    Each open takes a fresh report. Its size is not known until then, so
+    reads bypass the page cache."""
+    __slots__ = ('fs', 'data')
+    mode = GDBaseFile.mode | stat.S_IFREG
+
+    def __init__(self, fs):
+        GDBaseFile.__init__(self, STATS_PATH[1:])
+        self.fs = fs
+        self.data = ''
+
+    def open(self):
+        self.data = self.fs.report()
+
+    def close(self):
+        pass
+
+    def read(self, size, offset):
+        return self.data[offset:offset + size]
+
+    def readinto(self, buf, size, offset):
+        data = self.read(size, offset)
+        ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+class ChunkCache(object):
+    """LRU cache of file chunks, keyed by (uri, chunk index)."""
+    def __init__(self, budget=CACHESIZE):
+        self.budget = budget # Bytes
+        self.used = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.chunks
+
+    def get(self, key):
+        """Return the chunk stored under key, or None."""
+        with self.lock:
+            try:
+                data = self.chunks.pop(key)
+            except KeyError:
+                return None
+            self.chunks[key] = data # Move to the most recently used end.
+            return data
+
+    def put(self, key, data):
+        """Store a chunk, evicting the least recently used ones."""
+        with self.lock:
+            old = self.chunks.pop(key, None)
+            if old is not None:
+                self.used -= len(old)
+            self.chunks[key] = data
+            self.used += len(data)
+            while self.used > self.budget and self.chunks:
+                _, old = self.chunks.popitem(last=False)
+                self.used -= len(old)
+
+    def discard(self, uri):
+        """Drop every chunk belonging to the file at uri."""
+        with self.lock:
+            for key in [k for k in self.chunks if k[0] == uri]:
+                self.used -= len(self.chunks.pop(key))
+
+class ReadAhead(object):
+    """Read-ahead state of an open file handle.
+
+    Reads that continue where the previous one ended are sequential. Each
+    time a sequential reader enters a new chunk the window doubles, up to
+    READAHEAD_MAX chunks, and the chunks in the window are prefetched. Any
+    other read closes the window again."""
+    def __init__(self, f, prefetcher, maxwindow=READAHEAD_MAX):
+        self.file = f
+        self.prefetcher = prefetcher
+        self.maxwindow = maxwindow
+        self.next = 0    # Offset where a sequential read would start.
+        self.window = 0  # Chunks
+        self.chunk = -1  # Last chunk the window was grown in.
+        self.lock = threading.Lock()
+
+    def update(self, offset, size):
+        """Note a read of size bytes from offset and prefetch for it."""
+        with self.lock:
+            sequential = offset == self.next
+            self.next = offset + size
+            if not sequential:
+                self.window = 0
+                return
+            index = offset // CHUNKSIZE
+            if index == self.chunk:
+                return
+            self.chunk = index
+            self.window = min(max(1, 2 * self.window), self.maxwindow)
+            window = self.window
+        last = min(index + window, (self.file.size - 1) // CHUNKSIZE)
+        for i in xrange(index + 1, last + 1):
+            self.prefetcher.submit(self.file, i)
+
+class Prefetcher(object):
+    """Pool of threads downloading chunks into the caches.
+
+    It also keeps track of every chunk being downloaded, prefetched or
+    not, so that no chunk is downloaded twice at the same time."""
+    def __init__(self, nthreads=PREFETCH_THREADS):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.inflight = {} # (uri, index) -> Event set when done.
+        self.queued = set() # Claims in the queue, not started yet
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self.run, name='prefetch-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, f, index):
+        """Schedule chunk index of f for download, unless cached."""
+        if f.staging is not None or f.cached(index) or \
+                not self.claim(f, index):
+            return
+        if hasattr(f.fs.pool, 'submit'):
+            # The event loop does the waiting, not one of our threads;
+            # they only store the chunk, which the loop must not.
+            start = index * CHUNKSIZE
+            try:
+                future = f.fetch_async(start,
+                                       min(start + CHUNKSIZE, f.size),
+                                       READAHEAD)
+            except Exception:
+                self.done(f, index)
+                raise
+            future.add_done_callback(
+                    lambda future: self.queue.put((f, index, future.result)))
+        else:
+            with self.lock:
+                self.queued.add((f.uri, index))
+            self.queue.put((f, index, None))
+
+    def finish(self, f, index, fetch):
+        """Store the chunk returned by fetch() and release its claim."""
+        try:
+            f.store(index, fetch())
+        except Exception as err:
+            # Nothing lost; the reader will fetch the chunk itself.
+            log.info('prefetch of %r, chunk %d: %s', f.name, index, err)
+        finally:
+            self.done(f, index)
+
+    def claim(self, f, index, steal=False):
+        """Mark chunk index of f as being downloaded by the caller.
+
+        Returns False if someone else already is, unless it is a prefetch
+        not started yet and steal is set. The caller must call done()
+        when finished, successful or not."""
+        key = (f.uri, index)
+        with self.lock:
+            if key in self.inflight:
+                if steal and key in self.queued:
+                    self.queued.discard(key)
+                    return True
+                return False
+            self.inflight[key] = threading.Event()
+            return True
+
+    def done(self, f, index):
+        """Release a claim on a chunk, waking up anyone waiting for it."""
+        with self.lock:
+            self.inflight.pop((f.uri, index)).set()
+
+    def wait(self, f, index):
+        """Wait for a pending download of a chunk. True if there was one."""
+        with self.lock:
+            done = self.inflight.get((f.uri, index))
+        if done is None:
+            return False
+        done.wait()
+        return True
+
+    def run(self):
+        while True:
+            f, index, fetch = self.queue.get()
+            if fetch is None: # Ours to download
+                with self.lock:
+                    if (f.uri, index) not in self.queued:
+                        continue # A reader took it over.
+                    self.queued.discard((f.uri, index))
+                start = index * CHUNKSIZE
+                fetch = lambda: f.fetch(start,
+                                        min(start + CHUNKSIZE, f.size),
+                                        READAHEAD)
+            self.finish(f, index, fetch)
+
+class Staging(object):
+    """Local copy of a file being written, uploaded in the background.
+
+    The file is read from here until the upload is done. gen counts the
+    changes made, so an upload knows if it is still the latest. Chunks
+    still as on Drive are filled in as they are first needed."""
+    def __init__(self, dirname, journal, path=None):
+        if path is None:
+            fd, self.path = tempfile.mkstemp(dir=dirname)
+            # Unbuffered, so writes survive us crashing.
+            self.file = os.fdopen(fd, 'w+b', 0)
+        else: # Left over from a previous mount
+            self.path = path
+            self.file = open(path, 'r+b', 0)
+        self.key = os.path.basename(self.path)
+        self.journal = journal
+        self.session = None # URL of the upload session, once started
+        self.base = None # record() of the file as on Drive, if it is
+        self.missing = set() # Chunks not filled in yet
+        self.limit = 0 # Bytes of them to fill in: it may be truncated since
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.uploading = threading.Lock()
+        self.writers = 0 # Handles open for writing
+        self.gen = 0
+        self.uploaded = 0 # gen of the last upload
+        self.failed = 0 # gen of the last failed upload
+        self.error = None # Why it failed
+
+    def dirty(self):
+        return self.uploaded < self.gen
+
+    def read(self, size, offset):
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def write(self, data, offset):
+        """Write data at offset. The chunks it partly covers must have
+        been filled in."""
+        with self.lock:
+            if self.missing:
+                # Those it covers whole need not be.
+                end = offset + len(data)
+                whole = set(self.gaps(offset, end)) - \
+                        set(self.gaps(offset, end, False))
+                if whole:
+                    self.missing -= whole
+                    self.save_missing()
+            self.file.seek(offset)
+            self.file.write(data)
+            self.changed()
+
+    def truncate(self, length):
+        with self.lock:
+            self.file.truncate(length)
+            if self.missing:
+                self.limit = min(self.limit, length)
+                self.missing = set(i for i in self.missing
+                                   if i * CHUNKSIZE < length)
+                self.save_missing()
+            self.changed()
+
+    def gaps(self, start, end, whole=True):
+        """Return the chunks overlapping [start, end) not filled in yet,
+        but those it covers whole unless whole is set. Call with the
+        lock held."""
+        if end <= start:
+            return []
+        return [i for i in xrange(start // CHUNKSIZE,
+                                  (end - 1) // CHUNKSIZE + 1)
+                if i in self.missing and
+                   (whole or start > i * CHUNKSIZE or
+                    end < min((i + 1) * CHUNKSIZE, self.limit))]
+
+    def fill(self, index, data):
+        """Fill in chunk index with data, its content on Drive, unless
+        that has been done or written over since."""
+        with self.lock:
+            if index in self.missing:
+                start = index * CHUNKSIZE
+                self.file.seek(start)
+                self.file.write(data[:self.limit - start])
+                self.missing.discard(index)
+                self.save_missing()
+
+    def save_missing(self):
+        self.journal.update(self.key, missing=sorted(self.missing),
+                            limit=self.limit)
+
+    def changed(self):
+        self.gen += 1
+        if self.session is not None:
+            # Its content is out of date. Only the first write after an
+            # upload starts gets here.
+            self.session = None
+            self.journal.update(self.key, session=None)
+
+    def begin(self, session, gen):
+        """Remember the session uploading gen, unless there are newer
+        changes, so it can be resumed after a crash."""
+        with self.lock:
+            if self.gen == gen:
+                self.session = session
+                self.journal.update(self.key, session=session)
+
+    def size(self):
+        with self.lock:
+            self.file.flush()
+            return os.fstat(self.file.fileno()).st_size
+
+    def finish(self, gen, error):
+        """Record the outcome of an upload of gen."""
+        with self.lock:
+            if error is None:
+                self.uploaded = max(self.uploaded, gen)
+            else:
+                self.failed = max(self.failed, gen)
+            self.error = error
+            self.cond.notify_all()
+
+    def wait(self, gen):
+        """Wait until gen has been uploaded; raise the error if it fails."""
+        with self.lock:
+            while self.uploaded < gen and self.failed < gen:
+                self.cond.wait()
+            if self.uploaded < gen:
+                raise self.error
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.journal.remove(self.key)
+
+class UploadJournal(object):
+    """The staged files of a mount, saved so their uploads can go on
+    after a crash.
+
+    Maps the name of each staging file to the resource id and name of its
+    file, and the upload session, if one has been started."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(os.path.join(path, 'journal.json')) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass # Missing or corrupt; the staged files are lost.
+        for name in os.listdir(path):
+            if name not in self.entries and \
+                    name not in ('journal.json', 'lock'):
+                os.unlink(os.path.join(path, name))
+        for name in self.entries.keys():
+            if not os.path.exists(os.path.join(path, name)):
+                del self.entries[name]
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(fields)
+            self.save()
+
+    def remove(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+    def save(self):
+        """Write the journal atomically. Call with the lock held."""
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, os.path.join(self.path, 'journal.json'))
+
+class Uploader(object):
+    """Threads uploading staged files, in the background."""
+    def __init__(self, nthreads=UPLOAD_THREADS):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = set() # Files waiting in the queue
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self.run, name='upload-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, f, delay=0):
+        """Schedule an upload of f, unless one is waiting already.
+
+        With a delay, wait that long first, and leave the upload to
+        whoever has f open for writing by then."""
+        if delay:
+            t = threading.Timer(delay, self.deferred, (f,))
+            t.daemon = True
+            t.start()
+            return
+        with self.lock:
+            if f in self.queued:
+                return
+            self.queued.add(f)
+        self.queue.put(f)
+
+    def deferred(self, f):
+        st = f.staging
+        if st is not None and not st.writers:
+            f.flush()
+
+    def run(self):
+        while True:
+            f = self.queue.get()
+            with self.lock:
+                self.queued.discard(f)
+            f.upload()
+
+def lock_dir(path):
+    """Make sure directory path exists, and lock it for this process.
+    Returns the lock file, which holds the lock until closed, or None if
+    another process has it."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    lockfile = open(os.path.join(path, 'lock'), 'w')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lockfile.close()
+        return None
+    return lockfile
+
+class DiskCache(object):
+    """Chunk store in a local directory which survives remounts.
+
+    Each file gets a sparse data file holding the chunks downloaded so far.
+    The index maps Drive ids to the version that was cached and the chunks
+    present, so unchanged content is never downloaded twice. Data files
+    are read through one shared mapping each."""
+    def __init__(self, path, budget=DISKCACHESIZE):
+        self.path = path
+        self.budget = budget # Bytes
+        self.used = 0
+        self.lock = threading.Lock()
+        self.maps = collections.OrderedDict() # uri -> mmap, LRU order
+        # File -> open handles. By file, as a new one's uri comes later.
+        self.pins = collections.defaultdict(int)
+        self.dirty = False
+        # Two processes sharing a cache would overwrite each other's index.
+        self.lockfile = lock_dir(path)
+        if self.lockfile is None:
+            raise DriveFSError('The cache in %s is in use' % path)
+        self.index = self.load_index()
+        self.thread = threading.Thread(target=self.run, name='evict')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load_index(self):
+        """Read the index and remove data files it does not know about."""
+        index = {}
+        try:
+            with open(os.path.join(self.path, 'index.json')) as f:
+                for uri, rec in json.load(f).iteritems():
+                    rec['chunks'] = set(rec['chunks'])
+                    index[uri] = rec
+        except (IOError, ValueError):
+            pass # Missing or corrupt; start from scratch.
+        known = set(self.datafile(uri) for uri in index)
+        for name in os.listdir(self.path):
+            fn = os.path.join(self.path, name)
+            if name.endswith('.data') and fn not in known:
+                os.unlink(fn)
+        self.used = sum(chunk_len(rec['size'], i)
+                        for rec in index.itervalues() for i in rec['chunks'])
+        return index
+
+    def save_index(self):
+        """Write the index atomically, if it has changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            index = dict((uri, dict(rec, chunks=sorted(rec['chunks'])))
+                         for uri, rec in self.index.iteritems())
+            self.dirty = False
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, os.path.join(self.path, 'index.json'))
+
+    def datafile(self, uri):
+        return os.path.join(self.path, hashlib.sha1(uri).hexdigest() + '.data')
+
+    def has(self, uri, version, index):
+        """Whether chunk index of version of uri is cached."""
+        with self.lock:
+            rec = self.index.get(uri)
+            return bool(rec) and rec['version'] == version and \
+                   index in rec['chunks']
+
+    def get(self, uri, version, index):
+        """Return chunk index of version of uri as a buffer, or None."""
+        with self.lock:
+            rec = self.index.get(uri)
+            if not rec or rec['version'] != version or \
+                    index not in rec['chunks']:
+                return None
+            rec['atime'] = time.time()
+            self.dirty = True
+            mm = self.mapping(uri, rec['size'])
+            if mm is None:
+                self.remove(uri)
+                return None
+        # The buffer keeps the mapping alive, even if uri is evicted.
+        return buffer(mm, index * CHUNKSIZE, chunk_len(rec['size'], index))
+
+    def mapping(self, uri, size):
+        """Return a read-only mapping of the data file of uri, or None.
+
+        Call with the lock held."""
+        mm = self.maps.pop(uri, None)
+        if mm is None:
+            try:
+                with open(self.datafile(uri), 'r+b') as f:
+                    st_size = os.fstat(f.fileno()).st_size
+                    if st_size > size:
+                        return None # Tampered with.
+                    # Reading past the end of a mapped file is SIGBUS, so
+                    # make sure it is all there.
+                    f.truncate(size)
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                return None
+        self.maps[uri] = mm
+        if len(self.maps) > MAXMAPS:
+            self.maps.popitem(last=False) # Unmapped once unreferenced.
+        return mm
+
+    def put(self, uri, version, size, index, data):
+        """Store chunk index of version of uri, a file of size bytes."""
+        with self.lock:
+            rec = self.index.get(uri)
+            if not rec or rec['version'] != version:
+                # New or changed file; the old content is worthless.
+                if rec:
+                    self.remove(uri)
+                rec = self.index[uri] = {'version': version, 'size': size,
+                                         'chunks': set(), 'atime': 0}
+                with open(self.datafile(uri), 'wb') as f:
+                    f.truncate(size) # Sparse, the size of the mapping.
+            if index in rec['chunks']:
+                return
+            with open(self.datafile(uri), 'r+b') as f:
+                f.seek(index * CHUNKSIZE)
+                f.write(data)
+            rec['chunks'].add(index)
+            rec['atime'] = time.time()
+            self.used += len(data)
+            self.dirty = True
+
+    def pin(self, f):
+        """Keep the file f from being evicted until unpinned."""
+        with self.lock:
+            self.pins[f] += 1
+
+    def unpin(self, f):
+        with self.lock:
+            self.pins[f] -= 1
+            if not self.pins[f]:
+                del self.pins[f]
+
+    def remove(self, uri):
+        """Forget uri and delete its data. Call with the lock held."""
+        rec = self.index.pop(uri)
+        self.maps.pop(uri, None)
+        self.used -= sum(chunk_len(rec['size'], i) for i in rec['chunks'])
+        self.dirty = True
+        try:
+            os.unlink(self.datafile(uri))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used files until under budget."""
+        with self.lock:
+            if self.used <= self.budget:
+                return
+            atime = lambda uri: self.index[uri]['atime']
+            pinned = set(f.uri for f in self.pins)
+            for uri in sorted(self.index, key=atime):
+                if uri in pinned:
+                    continue # Open, so likely to be read again soon.
+                self.remove(uri)
+                if self.used <= self.budget:
+                    break
+
+    def run(self):
+        """Evict and save the index periodically, in the background."""
+        while True:
+            time.sleep(EVICT_INTERVAL)
+            self.evict()
+            self.save_index()
+
+    def close(self):
+        self.evict()
+        self.save_index()
+        self.lockfile.close() # Releases the lock
+
+class ConnectionPool(object):
+    """Persistent HTTP(S) connections, shared between threads.
+
+    Connections are kept alive between requests, so that TCP and TLS setup
+    is paid once rather than per chunk. There are at most size connections
+    to each host; a borrower waits until one is returned."""
+    def __init__(self, size=POOLSIZE):
+        self.size = size
+        self.cond = threading.Condition()
+        self.idle = collections.defaultdict(list) # (scheme, host) -> conns
+        self.open = collections.defaultdict(int)  # (scheme, host) -> count
+        # Counters
+        self.requests = 0
+        self.reused = 0 # Requests served on a kept-alive connection.
+        self.waits = 0  # Borrowers who found every connection busy.
+        self.metrics = None # Stats to time requests in, if any
+        self.waited = 0.0
+
+    def borrow(self, key):
+        """Return a (connection, reused) pair for the host in key."""
+        with self.cond:
+            if not self.idle[key] and self.open[key] >= self.size:
+                self.waits += 1
+                t = time.time()
+                while not self.idle[key] and self.open[key] >= self.size:
+                    self.cond.wait()
+                self.waited += time.time() - t
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+            self.open[key] += 1
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=TIMEOUT), False
+        return httplib.HTTPConnection(host, timeout=TIMEOUT), False
+
+    def giveback(self, key, conn, keep):
+        """Return a borrowed connection, or close it unless keep."""
+        if not keep:
+            conn.close()
+        with self.cond:
+            if keep:
+                self.idle[key].append(conn)
+            else:
+                self.open[key] -= 1
+            self.cond.notify()
+
+    def request(self, method, url, headers={}, body=None, redirects=3):
+        """Perform a request and return (status, headers, body)."""
+        u = urlparse.urlsplit(url)
+        key = (u.scheme, u.netloc)
+        path = u.path + ('?' + u.query if u.query else '')
+        t = time.time()
+        while True:
+            conn, reused = self.borrow(key)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (httplib.HTTPException, socket.error):
+                self.giveback(key, conn, False)
+                if reused:
+                    continue # The server closed it while idle; try anew.
+                if self.metrics:
+                    self.metrics.op('http ' + method, time.time() - t, True)
+                raise
+            self.giveback(key, conn, not resp.will_close)
+            with self.cond:
+                self.requests += 1
+                self.reused += reused
+            if self.metrics:
+                self.metrics.op('http ' + method, time.time() - t,
+                                resp.status >= 400)
+            break
+        location = resp.getheader('location')
+        if resp.status in (301, 302, 303, 307) and location and redirects:
+            return self.request(method, location, headers, body,
+                                redirects - 1)
+        return resp.status, dict(resp.getheaders()), data
+
+    def stats(self):
+        """Return a dict of counters."""
+        with self.cond:
+            return {'requests': self.requests,
+                    'reused': self.reused,
+                    'reuse_rate': float(self.reused) / (self.requests or 1),
+                    'waits': self.waits,
+                    'wait_time': self.waited}
+
+class Future(object):
+    """The result of a request in progress, to be set by another thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.value = self.error = None
+        self.callbacks = []
+
+    def set_result(self, value):
+        self.finish(value, None)
+
+    def set_exception(self, error):
+        self.finish(None, error)
+
+    def finish(self, value, error):
+        with self.lock:
+            self.value, self.error = value, error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    def add_done_callback(self, fn):
+        """Call fn(self) when done, right away if already so."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def result(self, timeout=None):
+        """Wait for the result and return it, or raise the error."""
+        if timeout is None or self.done():
+            self.event.wait()
+        else:
+            # A timed wait polls in Python 2, waking up to 50 ms late; a
+            # timer wakes us on time instead.
+            wake = threading.Event()
+            timer = threading.Timer(timeout, wake.set)
+            timer.daemon = True
+            timer.start()
+            self.add_done_callback(lambda f: wake.set())
+            wake.wait()
+            timer.cancel()
+            if not self.done():
+                raise socket.timeout('timed out')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def then(self, fn):
+        """Return a Future of fn(result). Errors are passed on."""
+        future = Future()
+        def chain(f):
+            try:
+                future.set_result(fn(f.result()))
+            except Exception as err:
+                future.set_exception(err)
+        self.add_done_callback(chain)
+        return future
+
+def backoff(failures, headers=None, base=RETRY_BASE):
+    """Return the seconds to wait before retrying a request which failed
+    failures times, the last time with response headers.
+
+    The delay is jittered, so clients failing together do not retry
+    together. A Retry-After from the server is a lower bound."""
+    delay = random.uniform(0, min(RETRY_CAP, base * 2 ** failures))
+    hint = (headers or {}).get('retry-after')
+    if hint:
+        if hint.isdigit():
+            delay = max(delay, int(hint))
+        else:
+            when = email.utils.parsedate_tz(hint)
+            if when:
+                delay = max(delay, email.utils.mktime_tz(when) - time.time())
+    return delay
+
+def retryable(status):
+    """Whether a request answered with status may succeed if retried."""
+    return status >= 500 or status == 429
+
+def gather(futures):
+    """Return a Future of the list of results of futures, in order."""
+    result = Future()
+    left = [len(futures)]
+    lock = threading.Lock()
+    def done(f):
+        with lock:
+            left[0] -= 1
+            if left[0]:
+                return
+        try:
+            result.set_result([f.result() for f in futures])
+        except Exception as err:
+            result.set_exception(err)
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+class Downloader(object):
+    """Threads sending requests in the background, for ConnectionPool."""
+    def __init__(self, nthreads=DOWNLOADS):
+        self.queue = Queue.Queue()
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self.run, name='download-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, fn, *args):
+        """Call fn(*args) on one of the threads; return a Future."""
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    def run(self):
+        while True:
+            future, fn, args = self.queue.get()
+            try:
+                future.set_result(fn(*args))
+            except Exception as err:
+                future.set_exception(err)
+
+class TokenBucket(object):
+    """Limits the rate of bytes taken from it by any number of threads."""
+    def __init__(self, rate, burst=CHUNKSIZE):
+        self.rate = float(rate) # Bytes per second
+        self.burst = max(burst, rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        """Wait until n more bytes may go."""
+        with self.lock:
+            self.refill()
+            # Go into debt, and wait until it is paid off. Whoever comes
+            # next waits for that too.
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, n):
+        """Take n bytes if there are as many, and return 0. Otherwise
+        take nothing, and return the seconds until there will be."""
+        with self.lock:
+            self.refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            return (n - self.tokens) / self.rate
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+class Scheduler(object):
+    """Decides which requests go next: those of the most urgent class
+    first, each class up to its limit at once, and all of them at most
+    rate a second if given.
+
+    Background work waits here, rather than for a connection in front of
+    a read someone is waiting for."""
+    def __init__(self, limits=IO_LIMITS, rate=0):
+        self.limits = limits
+        self.running = [0] * len(limits)
+        self.queues = [collections.deque() for l in limits]
+        # A bucket of requests rather than bytes, with room for a second.
+        self.bucket = TokenBucket(rate, 1) if rate else None
+        self.timer = None # Set while waiting for the bucket
+        self.lock = threading.Lock()
+        self.metrics = None # Stats to time the waits in, if any
+
+    def schedule(self, prio, fn, key=None):
+        """Call fn() when a request of class prio may go, maybe on
+        another thread. The request must be release()d when done.
+
+        key is (url, first, last) for a range request, for promote()."""
+        if self.metrics:
+            metrics, t, go = self.metrics, time.time(), fn
+            def fn():
+                metrics.op('wait ' + IO_CLASSES[prio], time.time() - t)
+                go()
+        with self.lock:
+            self.queues[prio].append((prio, fn, key))
+        self.dispatch()
+
+    def promote(self, prio, url, start, end):
+        """Queue the requests waiting for bytes [start, end) of url as of
+        class prio, if less urgent, since someone of that class waits for
+        them. They still count against the limit of their own class."""
+        moved = 0
+        with self.lock:
+            for queue in self.queues[prio + 1:]:
+                for entry in list(queue):
+                    key = entry[2]
+                    if key and key[0] == url and key[1] < end and \
+                            key[2] >= start:
+                        queue.remove(entry)
+                        self.queues[prio].append(entry)
+                        moved += 1
+        if moved:
+            if self.metrics:
+                self.metrics.count('promotions', moved)
+            self.dispatch()
+
+    def acquire(self, prio):
+        """Wait until a request of class prio may go."""
+        ready = threading.Event()
+        self.schedule(prio, ready.set)
+        ready.wait()
+
+    def release(self, prio):
+        with self.lock:
+            self.running[prio] -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """Start whatever may go now."""
+        go = []
+        with self.lock:
+            for i, queue in enumerate(self.queues):
+                limit = self.limits[i]
+                while queue and (not limit or self.running[i] < limit):
+                    wait = self.bucket and self.bucket.reserve(1)
+                    if wait:
+                        # Nobody jumps the queue while the bucket fills.
+                        if not self.timer:
+                            self.timer = threading.Timer(wait, self.tick)
+                            self.timer.daemon = True
+                            self.timer.start()
+                        break
+                    prio, fn, _ = queue.popleft()
+                    self.running[prio] += 1
+                    go.append(fn)
+                else:
+                    continue
+                break
+        for fn in go:
+            fn()
+
+    def tick(self):
+        with self.lock:
+            self.timer = None
+        self.dispatch()
+
+class EventConnection(object):
+    """A non-blocking HTTP/1.1 connection, driven by an EventPool."""
+    def __init__(self, key):
+        self.key = key
+        scheme, netloc = key
+        u = urlparse.urlsplit('//' + netloc)
+        self.host = u.hostname
+        family, type, proto, _, addr = socket.getaddrinfo(
+                self.host, u.port or (443 if scheme == 'https' else 80),
+                0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, type, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.state = 'connect' # connect, handshake or ready
+        self.want = 'w' # What the TLS handshake waits for
+        self.req = None # The request being served, if any
+        self.reused = False
+        self.deadline = time.time() + TIMEOUT
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def wants(self):
+        """Return whether I wait to read, and to write."""
+        if self.state == 'connect':
+            return False, True
+        if self.state == 'handshake':
+            return self.want == 'r', self.want == 'w'
+        return True, bool(self.req and self.outbuf)
+
+    def start(self, req):
+        """Begin sending req, a tuple from EventPool.send."""
+        method, path, headers, body = req[:4]
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.key[1],
+                 'Accept-Encoding: identity']
+        lines.extend('%s: %s' % kv for kv in headers.iteritems())
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        self.outbuf = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+        self.req = req
+        self.inbuf = ''
+        self.got = 0 # Bytes received so far
+        self.status = None
+        self.body = []
+        self.deadline = time.time() + TIMEOUT
+
+    def writable(self):
+        """Make progress on connecting or sending."""
+        self.deadline = time.time() + TIMEOUT
+        if self.state == 'connect':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            if self.key[0] == 'https':
+                self.sock = ssl.create_default_context().wrap_socket(
+                        self.sock, server_hostname=self.host,
+                        do_handshake_on_connect=False)
+                self.state = 'handshake'
+            else:
+                self.state = 'ready'
+        elif self.state == 'handshake':
+            self.handshake()
+        elif self.req and self.outbuf:
+            try:
+                n = self.sock.send(self.outbuf)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.outbuf = self.outbuf[n:]
+
+    def handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want = 'r'
+        except ssl.SSLWantWriteError:
+            self.want = 'w'
+        else:
+            self.state = 'ready'
+
+    def readable(self):
+        """Make progress on receiving. Returns True once a response is
+        complete; raises EOFError if the server hangs up early."""
+        self.deadline = time.time() + TIMEOUT
+        if self.state == 'handshake':
+            self.handshake()
+            return False
+        # Read until told to wait, since TLS may hold on to data select()
+        # does not know about.
+        while True:
+            try:
+                data = self.sock.recv(RECVSIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return False
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            if not data:
+                if self.req and self.status and self.remaining == -1:
+                    self.keep = False
+                    return True # The body ran until the end.
+                raise EOFError('connection closed')
+            if not self.req:
+                raise EOFError('unexpected data') # Don't trust it again.
+            self.got += len(data)
+            self.inbuf += data
+            if self.parse():
+                return True
+
+    def parse(self):
+        """Consume inbuf. Returns True when the response is complete."""
+        while True:
+            if self.status is None:
+                end = self.inbuf.find('\r\n\r\n')
+                if end < 0:
+                    return False
+                lines = self.inbuf[:end].split('\r\n')
+                self.inbuf = self.inbuf[end + 4:]
+                version, status = lines[0].split(None, 2)[:2]
+                self.status = int(status)
+                self.headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    self.headers[name.strip().lower()] = value.strip()
+                if self.status < 200:
+                    self.status = None # 100 Continue and the like
+                    continue
+                self.keep = version == 'HTTP/1.1' and \
+                        self.headers.get('connection', '').lower() != 'close'
+                self.chunked = 'chunked' in \
+                        self.headers.get('transfer-encoding', '').lower()
+                if self.req[0] == 'HEAD' or self.status in (204, 304):
+                    return True
+                elif self.chunked:
+                    self.remaining = None # A size line comes next.
+                elif 'content-length' in self.headers:
+                    self.remaining = int(self.headers['content-length'])
+                    if not self.remaining:
+                        return True
+                else:
+                    self.remaining = -1 # Until the connection closes
+            elif self.remaining is None: # Size of the next chunk
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return False
+                size = int(self.inbuf[:end].split(';')[0], 16)
+                self.inbuf = self.inbuf[end + 2:]
+                self.remaining = size or 'trailer'
+            elif self.remaining == 'trailer':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return False
+                self.inbuf = self.inbuf[end + 2:]
+                if not end: # The empty line after any trailers
+                    return True
+            elif self.remaining == 'crlf': # After the data of a chunk
+                if len(self.inbuf) < 2:
+                    return False
+                self.inbuf = self.inbuf[2:]
+                self.remaining = None
+            elif self.remaining == -1:
+                self.body.append(self.inbuf)
+                self.inbuf = ''
+                return False
+            else:
+                data = self.inbuf[:self.remaining]
+                self.body.append(data)
+                self.inbuf = self.inbuf[len(data):]
+                self.remaining -= len(data)
+                if self.remaining:
+                    return False
+                if not self.chunked:
+                    return True
+                self.remaining = 'crlf'
+
+    def response(self):
+        """Return the (status, headers, body) received."""
+        return self.status, self.headers, ''.join(self.body)
+
+class EventPool(object):
+    """HTTP(S) client multiplexing requests on one thread with select().
+
+    A drop-in for ConnectionPool which also has submit(), returning a
+    Future instead of blocking. Any number of requests may be submitted;
+    they queue for at most size kept-alive connections to each host, and
+    no thread is tied up per request."""
+    def __init__(self, size=POOLSIZE):
+        self.size = size
+        self.lock = threading.Lock() # Guards pending, idle, open and
+                                     # connected.
+        self.pending = collections.defaultdict(collections.deque)
+        self.connected = [] # (conn, req) opened by connect(), for the loop
+        self.idle = collections.defaultdict(list) # (scheme, host) -> conns
+        self.open = collections.defaultdict(int)  # (scheme, host) -> count
+        self.conns = set() # Every open connection, idle or not.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        # Counters
+        self.requests = 0
+        self.reused = 0 # Requests served on a kept-alive connection.
+        self.waits = 0  # Requests which found every connection busy.
+        self.metrics = None # Stats to time requests in, if any
+        self.waited = 0.0
+        self.thread = threading.Thread(target=self.run, name='events')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, method, url, headers={}, body=None, redirects=3):
+        """Perform a request and return (status, headers, body)."""
+        return self.submit(method, url, headers, body, redirects).result()
+
+    def submit(self, method, url, headers={}, body=None, redirects=3):
+        """Start a request; return a Future of (status, headers, body)."""
+        future = Future()
+        def done(f):
+            try:
+                status, hdrs, data = f.result()
+            except Exception as err:
+                future.set_exception(err)
+                return
+            location = hdrs.get('location')
+            if status in (301, 302, 303, 307) and location and redirects:
+                self.submit(method, urlparse.urljoin(url, location), headers,
+                            body, redirects - 1).add_done_callback(
+                        lambda g: future.finish(g.value, g.error))
+            else:
+                future.set_result((status, hdrs, data))
+        self.send(method, url, headers, body).add_done_callback(done)
+        return future
+
+    def send(self, method, url, headers, body):
+        """Queue a single request, without following redirects."""
+        u = urlparse.urlsplit(url)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        future = Future()
+        # The last two are whether it may be retried, and when it was sent.
+        req = (method, path, headers, body, future, True, time.time())
+        if self.metrics:
+            metrics, t = self.metrics, req[6]
+            future.add_done_callback(lambda f: metrics.op('http ' + method,
+                    time.time() - t, f.error is not None or f.value[0] >= 400))
+        with self.lock:
+            self.pending[(u.scheme, u.netloc)].append(req)
+        os.write(self.wakeup_w, 'x')
+        return future
+
+    def dispatch(self):
+        """Hand queued requests to connections, opening more if allowed."""
+        opening = []
+        with self.lock:
+            ready, self.connected = self.connected, []
+            for key, queue in self.pending.items():
+                while queue and (self.idle[key] or
+                                 self.open[key] < self.size):
+                    req = queue.popleft()
+                    if self.idle[key]:
+                        conn = self.idle[key].pop()
+                        conn.reused = True
+                        ready.append((conn, req))
+                    else:
+                        self.open[key] += 1
+                        opening.append((key, req))
+                if not queue:
+                    del self.pending[key]
+            for conn, req in ready:
+                self.conns.add(conn)
+                waited = time.time() - req[6]
+                if waited > 0.001:
+                    self.waits += 1
+                    self.waited += waited
+                conn.start(req)
+        # Looking up the host blocks, so new connections are opened by
+        # threads of their own, and handed back to the loop.
+        for key, req in opening:
+            t = threading.Thread(target=self.connect, args=(key, req),
+                                 name='connect')
+            t.daemon = True
+            t.start()
+
+    def connect(self, key, req):
+        """Open a connection to key for req, off the loop."""
+        try:
+            conn = EventConnection(key)
+        except (socket.error, ssl.SSLError) as err:
+            with self.lock:
+                self.open[key] -= 1
+            os.write(self.wakeup_w, 'x') # Others may go in its place.
+            req[4].set_exception(err)
+            return
+        with self.lock:
+            self.connected.append((conn, req))
+        os.write(self.wakeup_w, 'x')
+
+    def drop(self, conn, err):
+        """Close conn, failing or retrying the request on it."""
+        conn.close()
+        self.conns.discard(conn)
+        req, conn.req = conn.req, None
+        with self.lock:
+            self.open[conn.key] -= 1
+            if conn in self.idle[conn.key]:
+                self.idle[conn.key].remove(conn)
+            if req and conn.reused and not conn.got and req[5]:
+                # The server closed it while idle; try once more anew.
+                self.pending[conn.key].appendleft(req[:5] + (False,) +
+                                                  req[6:])
+                return
+        if req:
+            req[4].set_exception(err)
+
+    def complete(self, conn):
+        """Pass on the response on conn and recycle the connection."""
+        req, conn.req = conn.req, None
+        with self.lock:
+            self.requests += 1
+            self.reused += conn.reused
+            if conn.keep:
+                self.idle[conn.key].append(conn)
+        if not conn.keep:
+            self.drop(conn, None)
+        req[4].set_result(conn.response())
+
+    def run(self):
+        while True:
+            self.dispatch()
+            rlist, wlist = [self.wakeup_r], []
+            for conn in self.conns:
+                r, w = conn.wants()
+                if r:
+                    rlist.append(conn)
+                if w:
+                    wlist.append(conn)
+            r, w, _ = select.select(rlist, wlist, [], 1.0)
+            if self.wakeup_r in r:
+                os.read(self.wakeup_r, 4096)
+            for conn in w:
+                try:
+                    conn.writable()
+                except Exception as err:
+                    self.drop(conn, err)
+            for conn in r:
+                if conn is self.wakeup_r or conn not in self.conns:
+                    continue
+                try:
+                    if conn.readable():
+                        self.complete(conn)
+                except Exception as err:
+                    self.drop(conn, err)
+            now = time.time()
+            for conn in list(self.conns):
+                if conn.deadline < now:
+                    self.drop(conn, socket.timeout('timed out'))
+
+    def stats(self):
+        """Return a dict of counters."""
+        with self.lock:
+            return {'requests': self.requests,
+                    'reused': self.reused,
+                    'reuse_rate': float(self.reused) / (self.requests or 1),
+                    'waits': self.waits,
+                    'wait_time': self.waited}
+
+class Histogram(object):
+    """Latencies counted in power-of-two buckets of microseconds."""
+    __slots__ = ('buckets', 'n', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 32 # Bucket b holds times under 2**b us.
+        self.n = self.errors = 0
+        self.total = self.max = 0.0
+
+    def add(self, seconds, failed=False):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), 31)] += 1
+        self.n += 1
+        self.errors += failed
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return an upper bound of the pth percentile, in seconds."""
+        rank = self.n * p / 100.0
+        seen = 0
+        for b, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** b / 1e6, self.max)
+        return self.max
+
+class Stats(object):
+    """Counters and latency histograms of a mount, for the stats file."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = collections.defaultdict(Histogram) # name -> Histogram
+        self.counters = collections.Counter()
+        self.started = time.time()
+
+    def op(self, name, seconds, failed=False):
+        """Record an operation or request of name taking seconds."""
+        with self.lock:
+            self.ops[name].add(seconds, failed)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        """Return the stats as text, one line per operation or counter."""
+        with self.lock:
+            ops = sorted((name, copy.copy(h)) for name, h in
+                         self.ops.iteritems())
+            counters = sorted(self.counters.iteritems())
+        lines = ['uptime %.0f' % (time.time() - self.started),
+                 '%-16s %9s %7s %9s %9s %9s %9s' % ('op', 'count',
+                 'errors', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms')]
+        for name, h in ops:
+            lines.append('%-16s %9d %7d %9.3f %9.3f %9.3f %9.3f' % (name,
+                         h.n, h.errors, h.total * 1e3 / h.n,
+                         h.percentile(50) * 1e3, h.percentile(99) * 1e3,
+                         h.max * 1e3))
+        lines.extend('%s %d' % kv for kv in counters)
+        hits, misses = (self.counters['chunk_hits'],
+                        self.counters['chunk_misses'])
+        if hits + misses:
+            lines.append('chunk_hit_ratio %.3f' %
+                         (float(hits) / (hits + misses)))
+        return '\n'.join(lines) + '\n'
+
+class RingHandler(logging.Handler):
+    """Keeps the last records in memory, unformatted, until dumped.
+
+    It may take more than the log shows, so that a SIGUSR2 after
+    something went wrong tells what led up to it."""
+    def __init__(self, size=RINGSIZE, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, handler):
+        """Pass the records kept to handler, oldest first."""
+        for record in list(self.records):
+            handler.handle(record)
+
+class AsyncHandler(logging.Handler):
+    """Passes records to another handler on a thread of its own, so
+    neither formatting nor writing them holds up the caller."""
+    def __init__(self, target):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.queue = Queue.Queue()
+        t = threading.Thread(target=self.run, name='log')
+        t.daemon = True
+        t.start()
+
+    def setLevel(self, level):
+        logging.Handler.setLevel(self, level)
+        self.target.setLevel(level)
+
+    def emit(self, record):
+        self.queue.put(record)
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+            finally:
+                self.queue.task_done()
+
+def setup_logging(filename=None, level=logging.WARNING,
+                  ringlevel=logging.INFO, sample=LOG_SAMPLE):
+    """Log to filename, or stderr, and keep a ring of recent records.
+
+    Returns the (output, ring) handlers."""
+    global LOG_SAMPLE
+    LOG_SAMPLE = max(sample, 1)
+    target = logging.FileHandler(filename) if filename else \
+             logging.StreamHandler(sys.stderr)
+    target.setFormatter(logging.Formatter(LOG_FORMAT))
+    target.setLevel(level)
+    output = AsyncHandler(target)
+    ring = RingHandler(level=ringlevel)
+    log.addHandler(output)
+    log.addHandler(ring)
+    log.propagate = False
+    set_log_level(output, level)
+    return output, ring
+
+def set_log_level(output, level):
+    """Change the level of output, and of the logger, to take records
+    for the ring too."""
+    global MY_DEBUG
+    output.setLevel(level)
+    log.setLevel(min([h.level for h in log.handlers] or [level]))
+    MY_DEBUG = log.isEnabledFor(logging.DEBUG)
+
+def watch_signals(handlers):
+    """Run handlers, a dict of signal -> function, on a thread of their
+    own.
+
+    Python only runs signal handlers in the main thread, which is stuck
+    in fuse_main() while mounted. Instead the signals are blocked, and a
+    thread waits for them with sigwait(). Call before starting threads,
+    so they inherit the mask."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    mask = ctypes.create_string_buffer(128) # Big enough for a sigset_t
+    libc.sigemptyset(mask)
+    for sig in handlers:
+        libc.sigaddset(mask, sig)
+    how = 1 if sys.platform == 'darwin' else 0 # SIG_BLOCK
+    err = libc.pthread_sigmask(how, mask, None)
+    if err:
+        raise OSError(err, os.strerror(err))
+    def run():
+        sig = ctypes.c_int()
+        while True:
+            if libc.sigwait(mask, ctypes.byref(sig)) == 0:
+                try:
+                    handlers[sig.value]()
+                except Exception:
+                    log.exception('handling signal %d', sig.value)
+    t = threading.Thread(target=run, name='signals')
+    t.daemon = True
+    t.start()
 
 class DriveFSError(Exception):
     """General exception which pertains to DriveFS directly."""
     pass
 
+class HTTPError(DriveFSError):
+    """Google answered a request with an unexpected status."""
+    def __init__(self, status, url):
+        DriveFSError.__init__(self, '%d %s: %s' % 
+                              (status, httplib.responses.get(status), url))
+        self.status = status
+
 class DriveFS(fuse.Operations):
     """Class representing a mounted filesystem with file operations."""
-    def __init__(self, email, password, path='/'):
+    def __init__(self, email, password, path='/', cachesize=CACHESIZE,
+                 cachedir=None, diskcachesize=DISKCACHESIZE,
+                 readahead=READAHEAD_MAX, poolsize=POOLSIZE,
+                 pagesize=PAGESIZE, sync_interval=SYNC_INTERVAL,
+                 snapshot=None, backend='threads', segsize=SEGMENTSIZE,
+                 downloads=DOWNLOADS, rw=False, upchunk=UPLOADCHUNK,
+                 uploads=UPLOAD_THREADS, stats=False, token=None,
+                 hedge=False, iolimits=IO_LIMITS, iorate=0, stagedir=None):
         self.email = email
-        self.root = None
-        self.cache = (None, None)
-
-        self.client = gdocs.DocsService(source=APPNAME)
-        self.client.http_client.debug = FUSE_DEBUG
-        self.client.ClientLogin(email, password)
+        self.tree = GDTree()
+        self.changestamp = None # Changes up to this one are in the tree.
+        self.walk_error = None # Why the last walk failed, if it did
+        self.synced = threading.Event() # Set once the tree matches Drive
+        self.snapshot = snapshot # File to save the tree in, or None.
+        self.client = None
+        self.token = token # Given, or from logging in
+        self.online = threading.Event() # Set when login() is done.
+        self.lock = threading.Lock() # Guards handles.
+        # All network I/O goes through the pool. The event backend runs it
+        # on a loop of its own, instead of in the threads asking for it.
+        if backend == 'events':
+            self.pool = EventPool(poolsize)
+        else:
+            self.pool = ConnectionPool(poolsize)
+        # Off by default; the cost is then a check per call.
+        self.stats = self.pool.metrics = Stats() if stats else None
+        self.scheduler = Scheduler(iolimits, iorate)
+        self.scheduler.metrics = self.stats
+        # Range requests slower than most get a duplicate.
+        self.hedge = hedge
+        self.latencies = collections.deque(maxlen=HEDGE_SAMPLES)
+        # Segments are downloaded downloads at a time; the event backend
+        # can have them all in flight and lets the pool size limit them.
+        # The threads backend sends every request on a thread of its own,
+        # with room for the duplicates if hedging.
+        self.segsize = segsize if downloads > 1 else 0
+        self.downloader = None
+        if backend != 'events':
+            nthreads = max(downloads, poolsize)
+            self.downloader = Downloader(2 * nthreads if hedge
+                                         else nthreads)
+        self.chunks = ChunkCache(cachesize)
+        self.prefetcher = Prefetcher()
+        self.readahead = readahead
+        self.handles = {} # fh -> (GDFile, ReadAhead or None)
+        self.calls = collections.defaultdict(int) # op -> calls, for trace()
+        self.writers = set() # Handles open for writing
+        self.fhs = itertools.count(1)
+        self.pagesize = pagesize
+        self.disk = None
+        if cachedir:
+            self.disk = DiskCache(os.path.join(cachedir, email),
+                                  diskcachesize)
+        self.rw = rw
+        if rw:
+            # Files being written are staged here, and uploaded later; so
+            # is the journal, for the next mount to go on with the uploads
+            # this one did not finish.
+            if self.disk:
+                stagedir = os.path.join(self.disk.path, 'staging')
+            elif stagedir is None:
+                stagedir = os.path.join(DISKCACHEDIR, email, 'staging')
+            self.stagedir = stagedir
+            self.stagelock = lock_dir(stagedir)
+            if self.stagelock is None:
+                raise DriveFSError('The files staged in %s are in use' %
+                                   stagedir)
+            self.journal = UploadJournal(self.stagedir)
+            self.upchunk = upchunk
+            self.uploader = Uploader(uploads)
 
-        self.refresh_tree() # Set self.root
+        if self.load_snapshot():
+            # Mount the old tree at once, log in and catch up later.
+            self.walker = threading.Thread(target=self.reconcile,
+                                           args=(email, password))
+        else:
+            self.login(email, password)
+            # Fill in self.tree while we get on with mounting.
+            self.walker = threading.Thread(target=self.walk)
+        self.walker.name = 'walk'
+        self.walker.daemon = True
+        self.walker.start()
+        if rw and self.journal.entries:
+            t = threading.Thread(target=self.recover, name='recover')
+            t.daemon = True
+            t.start()
+        if sync_interval:
+            self.syncer = threading.Thread(target=self.run_sync,
+                                           args=(sync_interval,), name='sync')
+            self.syncer.daemon = True
+            self.syncer.start()
 
     def __del__(self):
         # Destroy drive connection
@@ -194,94 +2269,792 @@ class DriveFS(fuse.Operations):
         return '<%s for %s at 0x%x>' % (self.__class__.__name__, self.email, 
                                         id(self))
 
+    def login(self, email, password):
+        """Log in to Google and remember the token, unless given one."""
+        try:
+            # Requests go through the pool; the client is only for login.
+            self.client = gdocs.DocsService(source=APPNAME)
+            self.client.http_client.debug = FUSE_DEBUG
+            if self.token is None:
+                self.client.ClientLogin(email, password)
+                self.token = self.client.GetClientLoginToken()
+        finally:
+            self.online.set() # Don't leave anyone waiting, even on failure.
+
+    def headers(self, extra={}):
+        """Return the headers of an authenticated request."""
+        self.online.wait()
+        if self.token is None:
+            raise DriveFSError('Not logged in to Google')
+        h = dict(self.client.additional_headers or {})
+        h['Authorization'] = 'GoogleLogin auth=%s' % self.token
+        h.update(extra)
+        return h
+
+    def get(self, url, headers={}, prio=METADATA):
+        """Fetch url with an authenticated GET and return the body."""
+        status, _, body = self.request('GET', url, self.headers(headers),
+                                       prio=prio)
+        if status != httplib.OK:
+            raise HTTPError(status, url)
+        return body
+
+    def request(self, method, url, headers={}, body=None, hedge=False,
+                prio=FOREGROUND):
+        """Like submit(), but wait for the response and return it. Raises
+        socket.timeout if there is none by DEADLINE, retries and all."""
+        deadline = time.time() + DEADLINE
+        future = self.submit(method, url, headers, body, hedge, prio)
+        return future.result(max(0, deadline - time.time()))
+
+    def submit(self, method, url, headers={}, body=None, hedge=False,
+               prio=FOREGROUND):
+        """Send a request of class prio, retrying on network errors, 5xx
+        and 429 with jittered backoff until DEADLINE. Return a Future of
+        (status, headers, body); errors and 5xx raise once out of tries.
+
+        With hedge set, and hedging on, a slow request gets a twin."""
+        result = Future()
+        deadline = time.time() + DEADLINE
+        def attempt(failures):
+            if hedge and self.hedge:
+                f = self.hedged(method, url, headers, body, prio)
+            else:
+                f = self.start(method, url, headers, body, prio)
+            f.add_done_callback(lambda f: finished(f, failures))
+        def finished(f, failures):
+            if f.error is None:
+                status, h, _ = f.value
+                if not retryable(status):
+                    return result.set_result(f.value)
+                err = HTTPError(status, url)
+            elif isinstance(f.error, NETERRORS) and \
+                    not isinstance(f.error, fuse.FuseOSError):
+                h, err = {}, f.error
+            else:
+                return result.set_exception(f.error)
+            delay = backoff(failures, h)
+            if failures >= RETRIES or time.time() + delay > deadline:
+                return result.set_exception(err)
+            log.info('%s %s: retry %d in %.1fs after %s', method, url,
+                     failures + 1, delay, err)
+            if self.stats:
+                self.stats.count('retries')
+            t = threading.Timer(delay, attempt, (failures + 1,))
+            t.daemon = True
+            t.start()
+        attempt(0)
+        return result
+
+    def start(self, method, url, headers, body, prio=FOREGROUND):
+        """Send a request once, when the scheduler lets it; return a
+        Future of the response. The threads backend sends it on one of
+        its threads, so that whoever waits for it can give up."""
+        result = Future()
+        def done(f):
+            self.scheduler.release(prio)
+            result.finish(f.value, f.error)
+        def go():
+            if hasattr(self.pool, 'submit'):
+                f = self.pool.submit(method, url, headers, body)
+            else:
+                f = self.downloader.submit(self.pool.request, method, url,
+                                           headers, body)
+            f.add_done_callback(done)
+        # Range requests are known by their bytes, to be promoted.
+        m = re.match(r'bytes=(\d+)-(\d+)$', headers.get('Range', ''))
+        key = m and (url, int(m.group(1)), int(m.group(2)))
+        self.scheduler.schedule(prio, go, key)
+        return result
+
+    def send(self, method, url, headers, body, prio=FOREGROUND):
+        """Send a request once, in this thread, when the scheduler lets
+        it, and return the response."""
+        self.scheduler.acquire(prio)
+        try:
+            return self.pool.request(method, url, headers, body)
+        finally:
+            self.scheduler.release(prio)
+
+    def hedged(self, method, url, headers, body, prio=FOREGROUND):
+        """Send a request, and a duplicate should it take longer than
+        most. Return a Future of whichever answers first."""
+        first = self.start(method, url, headers, body, prio)
+        t = time.time()
+        first.add_done_callback(
+                lambda f: self.latencies.append(time.time() - t))
+        latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_SAMPLES // 10:
+            return first # Too early to tell what slow is.
+        threshold = max(HEDGE_MIN,
+                        latencies[len(latencies) * HEDGE_PERCENTILE // 100])
+        result = Future()
+        lock = threading.Lock()
+        pending = [1] # Requests out
+        def done(f):
+            with lock:
+                pending[0] -= 1
+                # Take the first answer, or the last error.
+                if result.done() or f.error is not None and pending[0]:
+                    return
+                result.finish(f.value, f.error)
+        def hedge():
+            with lock:
+                if result.done():
+                    return
+                pending[0] += 1
+            if self.stats:
+                self.stats.count('hedges')
+            self.start(method, url, headers, body, prio).add_done_callback(
+                    done)
+        timer = threading.Timer(threshold, hedge)
+        timer.daemon = True
+        timer.start()
+        first.add_done_callback(done)
+        result.add_done_callback(lambda f: timer.cancel())
+        return result
+
+    def report(self):
+        """Return the text of the stats file."""
+        lines = [self.stats.report()]
+        lines.extend('pool_%s %s\n' % kv
+                     for kv in sorted(self.pool.stats().items()))
+        lines.append('memory_cache_bytes %d\n' % self.chunks.used)
+        if self.disk:
+            lines.append('disk_cache_bytes %d\n' % self.disk.used)
+        return ''.join(lines)
+
     def getfile(self, path):
         """Return the local object for the file at path (absolute)."""
-        pl = full_split(path)
-        if not pl or pl.pop() != '/': # Removes /
+        if not path.startswith('/'):
             raise DriveFSError('Path was not absolute: %s' % path)
-        f = self.root 
-        try:
-            while pl:
-                f = f.child(pl.pop())
-        except KeyError:
-            raise FuseOSError(errno.ENOENT)
+        if path == STATS_PATH and self.stats:
+            return StatsFile(self)
+        f = self.tree.lookup(path)
+        if f is None:
+            # Without a full listing, we cannot tell it is not there.
+            raise fuse.FuseOSError(errno.EIO if self.incomplete()
+                                   else errno.ENOENT)
+        return f
+
+    def incomplete(self):
+        """Whether the tree is known to lack files: the walk failed, and
+        there is no snapshot to go by."""
+        return self.walk_error is not None and self.changestamp is None
+
+    def upload(self, f, st, gen):
+        """Upload gen of the content staged in st to f, with a resumable
+        upload. Failed chunks are retried, and the upload goes on from
+        what Google has, or in the session of an earlier try.
+
+        Returns the FeedEntry of the new version."""
+        size = st.size()
+        session = st.session
+        offset = None # Unknown; ask Google.
+        failures = 0
+        while True:
+            err = None
+            try:
+                if session is None:
+                    session = self.start_upload(f, size)
+                    st.begin(session, gen)
+                    offset = 0
+                if offset is None:
+                    data, span = '', 'bytes */%d' % size
+                else:
+                    # Changes since are for the next upload, but the
+                    # range must stay within the size of this one.
+                    n = min(self.upchunk, size - offset)
+                    data = st.read(n, offset)
+                    data += '\0' * (n - len(data)) # Truncated since
+                    span = 'bytes %d-%d/%d' % (offset,
+                                               offset + len(data) - 1, size)
+                    if not data:
+                        span = 'bytes */%d' % size # Empty file
+                status, h, body = self.send('PUT', session,
+                        self.headers({'Content-Range': span}), data, BULK)
+            except HTTPError as err:
+                status, h = err.status, {}
+            except NETERRORS as err:
+                status, h = None, {}
+            if status == 308: # Resume Incomplete; send what is missing
+                m = re.match(r'bytes=0-(\d+)', h.get('range', ''))
+                last, offset = offset, int(m.group(1)) + 1 if m else 0
+                if last is None:
+                    continue # We only asked.
+                if offset > last:
+                    failures = 0 # Getting somewhere
+                    continue
+                # Google took none of it; back off like for any failure.
+            elif status in (httplib.OK, httplib.CREATED):
+                return parse_feed(body)[0][0]
+            elif status in (httplib.NOT_FOUND, httplib.GONE):
+                session = None # Expired; start over.
+            elif status is not None and not retryable(status):
+                raise err or HTTPError(status, session)
+            failures += 1
+            if failures > UPLOAD_RETRIES:
+                raise err or HTTPError(status, session)
+            log.info('upload of %r: retry %d after %s', f.name, failures,
+                     err or status)
+            time.sleep(backoff(failures - 1, h, UPLOAD_BACKOFF))
+            offset = None
+
+    def start_upload(self, f, size):
+        """Start an upload session for size bytes to f. Returns its URL."""
+        headers = dict(UPLOAD_HEADERS)
+        headers['X-Upload-Content-Length'] = str(size)
+        if f.rid.startswith('local:'): # Not on Drive yet
+            method, url = 'POST', UPLOAD_URL
+            headers['Slug'] = f.name.encode(CODING)
         else:
-            return f
+            method = 'PUT'
+            url = UPLOAD_URL + '/' + urllib.quote(f.rid)
+            headers['If-Match'] = '*' # Overwrite whatever is there.
+        url += '?convert=false'
+        status, h, _ = self.send(method, url, self.headers(headers), '',
+                                 BULK)
+        if status != httplib.OK or 'location' not in h:
+            raise HTTPError(status, url)
+        return h['location']
+
+    def recover(self):
+        """Go on with the uploads of a previous mount, once the tree is
+        in. Files not in it then are gone from Drive too, and so are
+        their uploads; until then, nothing is."""
+        self.synced.wait()
+        for key, rec in self.journal.entries.items():
+            rid = rec['rid']
+            if rid.startswith('local:'): # Never made it to Drive
+                f = GDFile.new(rec['name'], self)
+                self.tree.add(f.rid, f)
+            else:
+                f = self.tree.byid.get(rid)
+            st = Staging(self.stagedir, self.journal,
+                         os.path.join(self.stagedir, key))
+            if f is None or f.staging is not None: # Deleted, or busy
+                st.discard()
+                continue
+            st.session = rec.get('session')
+            st.missing = set(rec.get('missing', ()))
+            st.limit = rec.get('limit', 0)
+            st.gen = 1
+            if f.uri is not None:
+                st.base = f.record()
+            f.staging = st
+            f.size = st.size()
+            self.journal.update(key, rid=f.rid)
+            f.flush()
+
+    def resolve(self, patterns):
+        """Return the files at the paths or matching the globs given."""
+        files = collections.OrderedDict()
+        for pattern in patterns:
+            if isinstance(pattern, str):
+                pattern = pattern.decode(CODING)
+            pattern = posixpath.join(u'/', pattern)
+            if not any(c in pattern for c in u'*?['):
+                f = self.tree.lookup(pattern)
+                if not isinstance(f, GDFile):
+                    raise DriveFSError('No such file: %s' %
+                                       pattern.encode(CODING))
+                files[pattern] = f
+                continue
+            for path in sorted(fnmatch.filter(self.tree.paths, pattern)):
+                f = self.tree.lookup(path)
+                if isinstance(f, GDFile):
+                    files[path] = f
+        return [f for f in files.values() if f.staging is None]
+
+    def warm(self, files, rate=0, nthreads=DOWNLOADS, out=sys.stderr):
+        """Download files into the cache, with progress written to out.
+
+        At most rate bytes/s are downloaded, if given. Returns the number
+        of chunks that failed."""
+        work = Queue.Queue()
+        left = {} # File -> chunks to go
+        bad = set() # Files with chunks that failed
+        total = 0
+        for f in files:
+            missing = [i for i in xrange((f.size - 1) // CHUNKSIZE + 1)
+                       if not f.cached(i)]
+            if missing:
+                f.open() # Not to be evicted under our feet.
+                left[f] = len(missing)
+                total += sum(chunk_len(f.size, i) for i in missing)
+            for i in missing:
+                work.put((f, i))
+        bucket = TokenBucket(rate) if rate else None
+        lock = threading.Lock()
+        progress = {'bytes': 0, 'files': len(files) - len(left),
+                    'failed': 0, 'shown': 0}
+        start = time.time()
+        def show(final=False):
+            now = time.time()
+            if not final and now - progress['shown'] < 0.5:
+                return
+            progress['shown'] = now
+            out.write('\rwarm: %d/%d files, %.1f/%.1f MB, %.1f MB/s%s' % (
+                    progress['files'], len(files),
+                    float(progress['bytes']) / MBYTES, float(total) / MBYTES,
+                    float(progress['bytes']) / MBYTES / max(now - start,
+                                                            1e-3),
+                    ', %d failed' % progress['failed']
+                    if progress['failed'] else ''))
+            if final:
+                out.write('\n')
+            out.flush()
+        def run():
+            while True:
+                try:
+                    f, i = work.get_nowait()
+                except Queue.Empty:
+                    return
+                if bucket:
+                    bucket.take(chunk_len(f.size, i))
+                try:
+                    f.load(i, i, BULK)
+                except Exception as err:
+                    log.warning('warming %r, chunk %d: %s', f.name, i, err)
+                    ok = False
+                else:
+                    ok = True
+                with lock:
+                    if ok:
+                        progress['bytes'] += chunk_len(f.size, i)
+                    else:
+                        progress['failed'] += 1
+                        bad.add(f)
+                    left[f] -= 1
+                    if not left[f]:
+                        progress['files'] += f not in bad
+                        f.close()
+                    show()
+        threads = [threading.Thread(target=run, name='warm-%d' % i)
+                   for i in xrange(nthreads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        show(True)
+        return progress['failed']
+
+    def walk(self):
+        """Fill in the tree with refresh_tree(), or bring one from a
+        snapshot up to date with sync(), retrying with backoff until it
+        goes through. Meanwhile walk_error says why it has not."""
+        catch_up = self.refresh_tree if self.changestamp is None \
+                   else self.sync
+        failures = 0
+        while True:
+            try:
+                catch_up()
+            except Exception as err:
+                log.warning('listing files: %s', err)
+                self.walk_error = err
+                failures += 1
+                time.sleep(backoff(failures))
+            else:
+                self.walk_error = None
+                return
 
     def refresh_tree(self):
-        """Sync the local tree with Google and rebuild it."""
-        q = gdocs.DocumentQuery(params={'showfolders': 'false'})
-        entries = self.client.GetDocumentListFeed(q.ToUri()).entry
-        # Construct root tree.
-        self.root = GDDir(None, files=[GDFile(e, self.client) for e in entries])
+        """Fill in the tree from the document list, walking all of it.
+
+        The tree is already mounted, and grows as pages of the listing
+        arrive. Should an earlier walk have failed half way, this one
+        takes over what it got."""
+        tree = self.tree
+        stale = set(tree.byid)
+        # Changes made during the walk are applied by the next sync.
+        changestamp = self.largest_changestamp()
+        q = gdocs.DocumentQuery(params={'showfolders': 'false',
+                                        'max-results': str(self.pagesize)})
+        for e in self.iter_entries(DOCS_SERVER + q.ToUri()):
+            rid = resource_id(e)
+            if rid in stale:
+                stale.discard(rid)
+                tree.update(rid, GDFile(e, self))
+            else:
+                tree.add(rid, GDFile(e, self))
+        # Gone since the failed walk, unless changed here.
+        for rid in stale:
+            f = tree.byid.get(rid)
+            if f is not None and f.staging is None:
+                tree.remove(rid)
+        self.changestamp = changestamp
+        self.synced.set()
+        self.save_snapshot()
+
+    def reconcile(self, email, password):
+        """Log in and bring a tree loaded from a snapshot up to date."""
+        self.login(email, password)
+        self.walk()
+
+    def load_snapshot(self):
+        """Load the tree saved by save_snapshot(). Return success."""
+        if not self.snapshot:
+            return False
+        try:
+            with open(self.snapshot, 'rb') as f:
+                fmt, changestamp, files = marshal.loads(
+                        zlib.decompress(f.read()))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            return False # Missing or corrupt; do a full walk instead.
+        if fmt != SNAPSHOT_FORMAT:
+            return False
+        for rec in files:
+            self.tree.add(rec[0], GDFile.from_record(rec[1:], self, rec[0]))
+        self.changestamp = changestamp
+        return True
+
+    def save_snapshot(self):
+        """Save the tree to the snapshot file, for the next mount."""
+        changestamp = self.changestamp # Read it before the tree.
+        if not self.snapshot or changestamp is None:
+            return
+        files = []
+        for rid, f in self.tree.byid.items():
+            # Files being written go in as Drive has them, which is what
+            # the changes after changestamp apply to.
+            st = f.staging
+            rec = f.record() if st is None else st.base
+            if rec is not None: # Unless not on Drive yet
+                files.append((rid,) + rec)
+        data = zlib.compress(marshal.dumps((SNAPSHOT_FORMAT, changestamp,
+                                            files)), 1)
+        dirname = os.path.dirname(self.snapshot) or '.'
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self.snapshot)
+
+    def iter_entries(self, url, headers={}):
+        """Generate the entries of a feed, following its next links.
+
+        Only one page is held in memory at a time."""
+        while url:
+            entries, url, _ = parse_feed(self.get(url, headers))
+            for e in entries:
+                yield e
+
+    def largest_changestamp(self):
+        """Return the number of the latest change to the account."""
+        _, _, changestamp = parse_feed(
+                self.get(CHANGES_URL + '?max-results=1', CHANGES_HEADERS))
+        return changestamp or 0
+
+    def sync(self):
+        """Apply the changes since the last sync or refresh to the tree."""
+        if self.changestamp is None:
+            return # The tree is still being built.
+        changestamp = self.changestamp
+        url = '%s?start-index=%d&max-results=%d' % \
+                (CHANGES_URL, changestamp + 1, self.pagesize)
+        for e in self.iter_entries(url, CHANGES_HEADERS):
+            self.apply_change(e)
+            changestamp = max(changestamp, e.changestamp)
+        self.changestamp = changestamp
+        self.synced.set()
+
+    def apply_change(self, e):
+        """Add, update or remove the file described by a change entry."""
+        if e.kind == 'folder':
+            return # No directories yet.
+        if e.gone:
+            f = self.tree.remove(resource_id(e))
+            if f:
+                self.chunks.discard(f.uri)
+        else:
+            # Keeps the caches if the content is unchanged.
+            self.tree.update(resource_id(e), GDFile(e, self))
+
+    def run_sync(self, interval):
+        """Sync every interval seconds, in the background."""
+        saved = time.time()
+        while True:
+            time.sleep(interval)
+            if self.walker.is_alive():
+                continue # Still catching up, trying until it does.
+            try:
+                self.sync()
+                if time.time() - saved > SNAPSHOT_INTERVAL:
+                    self.save_snapshot()
+                    saved = time.time()
+            except Exception as err:
+                log.warning('sync: %s', err)
 
     ###
     ### FUSE method overloads
     ###
 
+    def __call__(self, op, *args):
+        if MY_DEBUG:
+            self.trace(op, args)
+        # Operations defines every op, so no need to check for them.
+        stats = self.stats
+        if stats is None:
+            try:
+                return getattr(self, op)(*args)
+            except fuse.FuseOSError:
+                raise
+            except Exception as err:
+                raise self.failed(op, args, err)
+        t = time.time()
+        try:
+            ret = getattr(self, op)(*args)
+        except Exception as err:
+            stats.op(op, time.time() - t, True)
+            if isinstance(err, fuse.FuseOSError):
+                raise
+            raise self.failed(op, args, err)
+        stats.op(op, time.time() - t)
+        if op == 'readinto':
+            stats.count('bytes_read', ret)
+        elif op == 'read':
+            stats.count('bytes_read', len(ret))
+        return ret
+
+    def failed(self, op, args, err):
+        """Log an unexpected error and return the EIO to raise instead;
+        FUSE would make it an EFAULT."""
+        log.warning('%s%r failed', op, args[:1], exc_info=True)
+        return fuse.FuseOSError(errno.EIO)
+
+    def trace(self, op, args):
+        """Log a call, or a sample of them for the busiest ops."""
+        if op in ('getattr', 'read', 'readinto', 'write'):
+            n = self.calls[op] = self.calls[op] + 1 # Races only skew it.
+            if n % LOG_SAMPLE:
+                return
+        if op == 'readinto':
+            args = args[:1] + args[2:] # Not the buffer
+        elif op == 'write':
+            args = (args[0], len(args[1])) + args[2:] # Not the data
+        # Formatted later, by the thread writing the log.
+        log.debug('%s%r', op, args)
+
+    def direct_io(self, path):
+        return path == STATS_PATH
+
     def readdir(self, path, fh):
         """Get a list of files in path."""
-        if MY_DEBUG:
-            print 'readdir(%s, %s)' % (path.encode(CODING), fh)
         r = self.getfile(path)
-        return ['.', '..'] + [f.name for f in r.dirs + r.files]
+        if self.incomplete():
+            # Rather than pass off what we have as all there is.
+            raise fuse.FuseOSError(errno.EIO)
+        # Libfuse 2 passes on no more than the type of each, so the kernel
+        # asks getattr for the rest anyway, and attr_timeout caches that.
+        # keys() copies, so a sync may go on while we list.
+        return ['.', '..'] + r.children.keys()
 
     def getattr(self, path, fh):
         """Returns a stat(2)-like dict of attributes."""
-        if MY_DEBUG:
-            print 'getattr(%s, %s)' % (path.encode(CODING), fh)
         f = self.getfile(path)
-        return f.stat
+        st = f.stat
+        if self.rw and isinstance(f, GDFile):
+            st['st_mode'] |= stat.S_IWUSR
+        return st
+
+    def handle(self, fh, offset, size):
+        """Return the file open as fh, telling its read-ahead of a read."""
+        with self.lock:
+            f, ra = self.handles.get(fh) or (None, None)
+        if f is None:
+            raise fuse.FuseOSError(errno.EBADF)
+        if ra:
+            ra.update(offset, size)
+        return f
 
     def read(self, path, size, offset, fh):
         """Read at most size bytes from offset from the file at path."""
-        if MY_DEBUG:
-            print 'read(%s, %s, %s, %s)' % \
-                        (path.encode(CODING), size, offset, fh)
-        f = self.getfile(path)
-        return f.read(size, offset)
+        return self.handle(fh, offset, size).read(size, offset)
+
+    def readinto(self, path, buf, size, offset, fh):
+        """Copy at most size bytes from offset into the FUSE buffer."""
+        f = self.handle(fh, offset, size)
+        return f.readinto(buf, size, offset)
 
     def open(self, path, flags):
-        """Open the file at path for reading."""
+        """Open the file at path. Returns a new handle."""
         f = self.getfile(path)
+        writing = flags & (os.O_WRONLY | os.O_RDWR)
+        if writing:
+            if not self.rw:
+                raise fuse.FuseOSError(errno.EROFS)
+            if not isinstance(f, GDFile):
+                raise fuse.FuseOSError(errno.EACCES)
+            f.open_write(truncate=flags & os.O_TRUNC)
         f.open()
+        ra = None
+        if self.readahead and not writing and isinstance(f, GDFile):
+            ra = ReadAhead(f, self.prefetcher, self.readahead)
+        with self.lock:
+            fh = self.fhs.next()
+            # The handle holds on to the file, even if it is renamed or
+            # deleted while open.
+            self.handles[fh] = (f, ra)
+            if writing:
+                self.writers.add(fh)
+        return fh
+
+    def create(self, path, mode, fi=None):
+        """Create a file at path and open it for writing."""
+        if not self.rw:
+            raise fuse.FuseOSError(errno.EROFS)
+        name = path[1:]
+        if '/' in name:
+            raise fuse.FuseOSError(errno.ENOENT) # No directories yet.
+        f = GDFile.new(name, self)
+        self.tree.add(f.rid, f)
+        if self.tree.lookup(path) is not f:
+            self.tree.remove(f.rid)
+            raise fuse.FuseOSError(errno.EEXIST)
+        return self.open(path, os.O_WRONLY | os.O_TRUNC)
+
+    def write(self, path, data, offset, fh):
+        """Write data at offset. It is uploaded later."""
+        with self.lock:
+            f, _ = self.handles.get(fh) or (None, None)
+            if fh not in self.writers:
+                raise fuse.FuseOSError(errno.EBADF)
+        return f.write(data, offset)
+
+    def truncate(self, path, length, fh=None):
+        if not self.rw:
+            raise fuse.FuseOSError(errno.EROFS)
+        f = self.getfile(path)
+        if not isinstance(f, GDFile):
+            raise fuse.FuseOSError(errno.EISDIR)
+        f.open_write(truncate=not length)
+        try:
+            if length:
+                f.truncate(length)
+        finally:
+            f.close_write(upload=False)
+        # The kernel does `> file` as a truncate and then an open, whose
+        # release uploads it all at once. Upload it ourselves if not.
+        self.uploader.submit(f, UPLOAD_DELAY)
+        return 0
+
+    def flush(self, path, fh):
+        """Called on each close(2); starts the upload of any changes."""
+        with self.lock:
+            f, _ = self.handles.get(fh) or (None, None)
+        if f:
+            f.flush()
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        """Wait until the changes made to the file are on Drive."""
+        with self.lock:
+            f, _ = self.handles.get(fh) or (None, None)
+        if f:
+            try:
+                f.fsync()
+            except Exception:
+                raise fuse.FuseOSError(errno.EIO)
         return 0
 
     def release(self, path, fh):
-        """Close the file at path."""
-        f = self.getfile(path)
-        f.close()
+        """Close a handle of the file at path."""
+        with self.lock:
+            f, _ = self.handles.pop(fh, (None, None))
+            writing = fh in self.writers
+            self.writers.discard(fh)
+        if f:
+            if writing:
+                f.close_write()
+            f.close()
         return 0
 
+    def destroy(self, path):
+        """Called on unmount."""
+        for f in self.tree.byid.values():
+            if f.staging is not None:
+                try:
+                    f.fsync()
+                except Exception as err:
+                    log.error('%r was not uploaded: %s', f.name, err)
+        self.save_snapshot()
+        if self.disk:
+            self.disk.close()
+        if self.rw:
+            self.stagelock.close()
+        log.info('pool: %s', self.pool.stats())
+
+_days = {} # 'YYYY-MM-DD' -> time_t of midnight, UTC
+
 def gdtime_to_ctime(timestr):
     """Convert a time-string in Google format to Unix style time_t."""
     # Note: milliseconds are stripped away.
     # Sample Google time: 2012-05-22T19:07:06.721Z
+    # strptime is slow, so it is only used once per day seen.
     try:
-        timestr = timestr[0:timestr.find('.')] # Cut away decimals
-        t = time.strptime(timestr, '%Y-%m-%dT%H:%M:%S')
-    except AttributeError: 
-        return 0 # Dunno why this happens. Well, well.
-    else:
-        return int(time.mktime(t)) # Convert to C-style time_t
-
-def full_split(head):
-    """Split a path fully into components and return a reversed list."""
-    l = []
-    while True:
-        (head, tail) = posixpath.split(head)
-        if tail and head:
-            l.append(tail)
+        day = _days.get(timestr[:10])
+        if day is None:
+            day = _days[timestr[:10]] = calendar.timegm(
+                    time.strptime(timestr[:10], '%Y-%m-%d'))
+        return day + int(timestr[11:13]) * 3600 + \
+               int(timestr[14:16]) * 60 + int(timestr[17:19])
+    except (TypeError, ValueError):
+        return 0 # Missing or mangled.
+
+# Text of these entry elements goes into the FeedEntry attribute named.
+ENTRY_TEXT = {ATOM + 'id':          'id',
+              ATOM + 'title':       'title',
+              ATOM + 'published':   'published',
+              ATOM + 'updated':     'updated',
+              GD + 'lastViewed':    'viewed',
+              GD + 'resourceId':    'rid'}
+
+def use_server(url):
+    """Talk to the server at url instead of Google, e.g. fakedrive.py."""
+    global DOCS_SERVER, CHANGES_URL, UPLOAD_URL
+    old = DOCS_SERVER
+    DOCS_SERVER = url.rstrip('/')
+    CHANGES_URL = CHANGES_URL.replace(old, DOCS_SERVER, 1)
+    UPLOAD_URL = UPLOAD_URL.replace(old, DOCS_SERVER, 1)
+
+def parse_feed(data):
+    """Parse a page of a feed in a single pass over the raw XML.
+
+    Returns a list of FeedEntries, the URL of the next page (or None) and
+    the largest changestamp of the account (or None)."""
+    entries, next, changestamp = [], None, None
+    e = None
+    for event, elem in etree.iterparse(cStringIO.StringIO(data),
+                                       ('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == ATOM + 'entry':
+                e = FeedEntry()
             continue
-        elif head: # Happens for absolute paths
-            l.append(head)
-            break
-        elif tail: # Happens for non-absolute paths
-            l.append(tail)
-            break
-        else:      # Should not happen.
-            break
-    return l # Will be reversed!
+        if e is None: # Feed level
+            if tag == ATOM + 'link' and elem.get('rel') == 'next':
+                next = elem.get('href')
+            elif tag == DOCS + 'largestChangestamp':
+                changestamp = int(elem.get('value'))
+        elif tag in ENTRY_TEXT:
+            setattr(e, ENTRY_TEXT[tag], elem.text)
+        elif tag == GD + 'quotaBytesUsed':
+            e.size = int(elem.text)
+        elif tag == ATOM + 'content':
+            e.src = elem.get('src')
+        elif tag == ATOM + 'category':
+            if elem.get('scheme') == GD[1:-1] + '#kind':
+                e.kind = elem.get('label')
+        elif tag == DOCS + 'changestamp':
+            e.changestamp = int(elem.get('value'))
+        elif tag in (GD + 'deleted', DOCS + 'removed'):
+            e.gone = True
+        elif tag == ATOM + 'entry':
+            entries.append(e)
+            e = None
+            elem.clear()
+    return entries, next, changestamp
 
 def path_to_uri(path):
     """Get the resource-URI for a given path in the filesystem."""
@@ -298,25 +3071,193 @@ def path_to_uri(path):
         q['title'] = fn.encode(CODING)
         q['title-exact'] = 'true'
         return q.ToUri()
-def get_filesize(entry):
-    # Hacking a filesize getter onto the Drive API
-    # NOTE: A shameless kludge.
-    s = entry.ToString()
-    try:
-        m = re.search(r':quotaBytesUsed.*>(\d+)</', s)
-        filesize = int(m.groups()[0])
-        return filesize
-    except AttributeError: # No match
-        return 0 # Couldn't determine file size    
+def resource_id(entry):
+    """Return the id of an entry, the same in every feed and version."""
+    return entry.rid or entry.id
+
+def chunk_len(filesize, index):
+    """Return the length of chunk index of a file of filesize bytes."""
+    return min(CHUNKSIZE, filesize - index * CHUNKSIZE)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog=APPNAME)
     parser.add_argument('email')
     parser.add_argument('password')
-    parser.add_argument('mountpoint')
+    parser.add_argument('mountpoint', nargs='?',
+                        help='where to mount; optional when warming')
+    parser.add_argument('--cache-size', type=int, default=CACHESIZE // MBYTES,
+                        metavar='MB',
+                        help='memory budget for chunks without a disk cache')
+    parser.add_argument('--cache-dir', default=DISKCACHEDIR,
+                        help='directory of the persistent content cache')
+    parser.add_argument('--disk-cache-size', type=int,
+                        default=DISKCACHESIZE // MBYTES, metavar='MB',
+                        help='size cap of the persistent content cache')
+    parser.add_argument('--no-disk-cache', dest='cache_dir',
+                        action='store_const', const=None,
+                        help='do not keep content across mounts')
+    parser.add_argument('--readahead', type=int, default=READAHEAD_MAX,
+                        metavar='CHUNKS',
+                        help='largest read-ahead window (0 disables)')
+    parser.add_argument('--threads', action='store_true',
+                        help='serve requests from several threads')
+    parser.add_argument('--pool-size', type=int, default=POOLSIZE,
+                        help='HTTP connections per host')
+    parser.add_argument('--segment-size', type=int,
+                        default=SEGMENTSIZE // KBYTES, metavar='KB',
+                        help='split downloads into requests of this size '
+                             '(0 disables)')
+    parser.add_argument('--downloads', type=int, default=DOWNLOADS,
+                        help='segments downloaded at once')
+    parser.add_argument('--backend', choices=('threads', 'events'),
+                        default='threads',
+                        help='do network I/O in the calling threads, or '
+                             'multiplexed on an event loop')
+    parser.add_argument('--stats', action='store_true',
+                        help='count operations and time them, shown in '
+                             '%s on the mount' % STATS_PATH[1:])
+    levels = [logging.getLevelName(l).lower() for l in LOG_LEVELS]
+    parser.add_argument('--log', metavar='FILE',
+                        help='where to log; the default is stderr')
+    parser.add_argument('--log-level', choices=levels, default='warning',
+                        help='least important messages logged; SIGUSR1 '
+                             'steps through the levels')
+    parser.add_argument('--ring-level', choices=levels, default='info',
+                        help='least important messages kept in memory, '
+                             'written to the log on SIGUSR2')
+    parser.add_argument('--log-sample', type=int, default=LOG_SAMPLE,
+                        metavar='N',
+                        help='log 1 in N getattr, read and write calls')
+    parser.add_argument('--server', default=DOCS_SERVER, metavar='URL',
+                        help='where Drive is; see fakedrive.py for testing')
+    parser.add_argument('--token', help='use this auth token instead of '
+                                        'logging in')
+    parser.add_argument('--hedge', action='store_true',
+                        help='send a second request for a range when the '
+                             'first is slower than the %dth percentile'
+                             % HEDGE_PERCENTILE)
+    parser.add_argument('--io-limits', metavar='N,N,N,N',
+                        default=','.join(map(str, IO_LIMITS)),
+                        help='requests at once for reads, read-ahead, '
+                             'syncing and warming/uploads; 0 for no limit '
+                             '(default %(default)s)')
+    parser.add_argument('--io-rate', type=float, default=0,
+                        help='requests per second at most, all told')
+    parser.add_argument('--page-size', type=int, default=PAGESIZE,
+                        help='entries per page of the document list')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='where to save the tree between mounts')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='list every file on each mount')
+    parser.add_argument('--sync-interval', type=int, default=SYNC_INTERVAL,
+                        metavar='SECONDS',
+                        help='time between syncs of the tree (0 disables)')
+    parser.add_argument('--attr-timeout', type=float, default=ATTR_TIMEOUT,
+                        metavar='SECONDS',
+                        help='how long the kernel may cache attributes')
+    parser.add_argument('--entry-timeout', type=float, default=ATTR_TIMEOUT,
+                        metavar='SECONDS',
+                        help='how long the kernel may cache names')
+    parser.add_argument('--rw', action='store_true',
+                        help='mount read-write; changes are uploaded in '
+                             'the background')
+    parser.add_argument('--upload-chunk', type=int,
+                        default=UPLOADCHUNK // KBYTES, metavar='KB',
+                        help='bytes per upload request, in multiples of '
+                             '512 KB')
+    parser.add_argument('--uploads', type=int, default=UPLOAD_THREADS,
+                        help='files uploaded at once')
+    parser.add_argument('--warm', metavar='PATTERN', action='append',
+                        default=[],
+                        help='download the files at a path or glob into the '
+                             'disk cache before mounting (repeatable)')
+    parser.add_argument('--warm-list', metavar='FILE',
+                        help='warm the paths listed in FILE, - for stdin')
+    parser.add_argument('--warm-rate', type=float, default=0,
+                        metavar='MB/s', help='bandwidth cap when warming')
 
     args = parser.parse_args()
+    warm = list(args.warm)
+    if args.warm_list:
+        with (sys.stdin if args.warm_list == '-'
+              else open(args.warm_list)) as f:
+            warm.extend(line.rstrip('\n') for line in f if line.strip())
+    if not args.mountpoint and not warm:
+        parser.error('a mountpoint is needed, unless warming the cache')
+    if warm and not args.cache_dir:
+        parser.error('warming needs the disk cache')
+    try:
+        iolimits = tuple(int(n) for n in args.io_limits.split(','))
+    except ValueError:
+        iolimits = ()
+    if len(iolimits) != len(IO_CLASSES):
+        parser.error('--io-limits takes %d numbers' % len(IO_CLASSES))
+    if not args.mountpoint:
+        # Nobody to keep waiting; warm at full speed.
+        iolimits = iolimits[:BULK] + (0,)
+    if args.no_snapshot:
+        args.snapshot = None
+    elif not args.snapshot:
+        args.snapshot = os.path.join(DISKCACHEDIR, args.email + '.tree')
     
-    fs = fuse.FUSE(DriveFS(args.email, args.password), args.mountpoint, 
-                   foreground=True, nothreads=True, ro=True)
+    def next_level():
+        i = LOG_LEVELS.index(output.level) if output.level in LOG_LEVELS \
+            else -1
+        set_log_level(output, LOG_LEVELS[(i + 1) % len(LOG_LEVELS)])
+        log.warning('log level is now %s',
+                    logging.getLevelName(output.level))
+    def dump_ring():
+        log.warning('dumping the last %d messages', len(ring.records))
+        output.flush() # That one first
+        ring.dump(output.target)
+    # Before any thread is started
+    watch_signals({signal.SIGUSR1: next_level, signal.SIGUSR2: dump_ring})
+    output, ring = setup_logging(args.log, args.log_level.upper(),
+                                 args.ring_level.upper(), args.log_sample)
+
+    use_server(args.server)
+    try:
+        drivefs = DriveFS(args.email, args.password,
+                          cachesize=args.cache_size * MBYTES,
+                          cachedir=args.cache_dir,
+                          diskcachesize=args.disk_cache_size * MBYTES,
+                          readahead=args.readahead,
+                          poolsize=args.pool_size,
+                          pagesize=args.page_size,
+                          sync_interval=args.sync_interval,
+                          snapshot=args.snapshot,
+                          backend=args.backend,
+                          segsize=args.segment_size * KBYTES,
+                          downloads=args.downloads,
+                          rw=args.rw,
+                          upchunk=max(args.upload_chunk // 512, 1) * 512 *
+                                  KBYTES,
+                          uploads=args.uploads,
+                          stats=args.stats,
+                          token=args.token,
+                          hedge=args.hedge,
+                          iolimits=iolimits,
+                          iorate=args.io_rate)
+    except DriveFSError as err:
+        sys.exit('%s: %s' % (APPNAME, err))
+    if warm:
+        # Every file must be known. The walker tries until it is; we give
+        # up after the first failure, unless there is a snapshot.
+        while drivefs.walker.is_alive() and not drivefs.walk_error:
+            drivefs.walker.join(1)
+        if drivefs.incomplete():
+            sys.exit('%s: listing files: %s' % (APPNAME, drivefs.walk_error))
+        try:
+            files = drivefs.resolve(warm)
+        except DriveFSError as err:
+            sys.exit('%s: %s' % (APPNAME, err))
+        failed = drivefs.warm(files, args.warm_rate * MBYTES, args.downloads)
+        if not args.mountpoint:
+            drivefs.destroy(u'/')
+            sys.exit(1 if failed else 0)
+    fs = fuse.FUSE(drivefs, args.mountpoint, 
+                   foreground=True, nothreads=not args.threads,
+                   ro=not args.rw,
+                   attr_timeout=args.attr_timeout,
+                   entry_timeout=args.entry_timeout)
 
@@ -0,0 +1,295 @@
+#!/usr/bin/python2.7
+# coding: utf-8
+#
+# Copyright (c) 2012, Johan Förberg <johan@forberg.se>.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""A local stand-in for Google Drive, to run and measure DriveFS against.
+
+It serves the document list, the changes feed and file content, and takes
+resumable uploads, over plain HTTP, with configurable latency, bandwidth
+and misbehaviour. Mount against it with
+
+    drivefs.py --server http://127.0.0.1:PORT --token x user '' mnt"""
+
+import time
+import random
+import socket
+import argparse
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+FEED_HEAD = """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom'
+      xmlns:gd='http://schemas.google.com/g/2005'
+      xmlns:docs='http://schemas.google.com/docs/2007'>
+<id>https://docs.google.com/feeds/documents/private/full</id>
+<title>Available Documents</title>
+"""
+FEED_ENTRY = """<entry>
+<id>https://docs.google.com/feeds/documents/private/full/file%%3A%(n)d</id>
+<published>2012-05-22T19:07:06.721Z</published>
+<updated>2012-05-22T19:07:06.721Z</updated>
+<gd:lastViewed>2012-05-22T19:07:06.721Z</gd:lastViewed>
+<gd:resourceId>file:%(n)d</gd:resourceId>
+<title>file%(n)d</title>
+<category scheme='http://schemas.google.com/g/2005#kind'
+          term='http://schemas.google.com/docs/2007#file' label='file'/>
+<content type='application/octet-stream' src='%(server)s/content/%(n)d'/>
+<gd:quotaBytesUsed>%(size)d</gd:quotaBytesUsed>
+</entry>
+"""
+
+FEED_NEXT = """<link rel='next' type='application/atom+xml' href='%s'/>
+"""
+
+FEED_CHANGESTAMP = """<docs:largestChangestamp value='%d'/>
+"""
+
+UPLOAD_PATH = '/feeds/upload/create-session/default/private/full'
+
+# Every file has the same content: bytes counting up, modulo a prime so
+# that misplaced chunks show.
+PATTERN = ''.join(chr(i) for i in xrange(251)) * (2**20 // 251 + 2)
+
+def content(start, end):
+    """Return the bytes in [start, end) of any file."""
+    parts = []
+    while start < end:
+        off = start % 251
+        n = min(end - start, len(PATTERN) - off)
+        parts.append(PATTERN[off:off + n])
+        start += n
+    return ''.join(parts)
+
+def make_feed(sizes, start=0, count=None, next=None, server='http://fake',
+              changestamp=None):
+    """Return a page of an Atom document list with one entry per size."""
+    end = len(sizes) if count is None else min(start + count, len(sizes))
+    return FEED_HEAD + (FEED_NEXT % next if next else '') + \
+           (FEED_CHANGESTAMP % changestamp if changestamp else '') + \
+           ''.join(FEED_ENTRY % {'n': n, 'size': sizes[n], 'server': server}
+                   for n in xrange(start, end)) + '</feed>'
+
+def feed_page(url, sizes, server='http://fake'):
+    """Serve the page of a listing of sizes asked for in url."""
+    u = urlparse.urlsplit(url)
+    q = dict(urlparse.parse_qsl(u.query))
+    start = int(q.get('start-index', 1)) - 1
+    count = int(q.get('max-results', len(sizes) or 1))
+    next = None
+    if start + count < len(sizes):
+        q['start-index'] = str(start + count + 1)
+        next = urlparse.urlunsplit(u[:3] + 
+                ('&amp;'.join('%s=%s' % kv for kv in q.items()), ''))
+    return make_feed(sizes, start, count, next, server)
+
+class FakeDriveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the requests DriveFS makes, after the server's latency."""
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers and body go out in separate writes; don't let Nagle
+        # hold the body back for a delayed ACK.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+        path = self.path.split('?')[0]
+        if path.startswith('/content/'):
+            if random.random() < server.failrate:
+                return self.send(503, '', {'Retry-After': '0'})
+            if random.random() < server.slowrate:
+                time.sleep(server.slow)
+            self.send_content(int(path[9:]))
+        elif path == '/feeds/default/private/changes':
+            # Nothing ever changes.
+            self.send(200, make_feed([], changestamp=1))
+        elif path.startswith('/feeds/'):
+            self.send(200, feed_page(server.url + self.path, server.sizes,
+                                     server.url))
+        else:
+            self.send(404, '')
+
+    def do_POST(self):
+        self.do_PUT()
+
+    def do_PUT(self):
+        server = self.server
+        time.sleep(server.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+        path = self.path.split('?')[0]
+        if path == UPLOAD_PATH or path.startswith(UPLOAD_PATH + '/'):
+            self.start_upload(urllib.unquote(path[len(UPLOAD_PATH) + 1:]))
+        elif path.startswith('/upload/') and path[8:] in server.sessions:
+            if random.random() < server.failrate:
+                return self.send(503, '', {'Retry-After': '0'})
+            self.upload(server.sessions[path[8:]], body)
+        else:
+            self.send(404, '')
+
+    def start_upload(self, rid):
+        """Open a session for a new file, or for a new version of rid."""
+        server = self.server
+        if rid and not (rid.startswith('file:') and
+                        int(rid[5:]) < len(server.sizes)):
+            return self.send(404, '')
+        with server.lock:
+            session = str(len(server.sessions))
+            server.sessions[session] = [int(rid[5:]) if rid else None, [],
+                    0, int(self.headers['X-Upload-Content-Length'])]
+        self.send(200, '', {'Location': server.url + '/upload/' + session})
+
+    def upload(self, s, body):
+        """Take a chunk of an upload, answering like Google does."""
+        server = self.server
+        n, chunks, have, size = s
+        r = self.headers.get('Content-Range', '')
+        if r.startswith('bytes ') and r[6] != '*':
+            first = int(r[6:].partition('-')[0])
+            if first == have: # Else a resend of what we have
+                chunks.append(body)
+                s[2] = have = have + len(body)
+        if have < size:
+            return self.send(308, '', {'Range': 'bytes=0-%d' % (have - 1)}
+                                      if have else {})
+        with server.lock:
+            if n is None:
+                n = s[0] = len(server.sizes)
+                server.sizes.append(size)
+            server.sizes[n] = size
+            server.files[n] = ''.join(chunks)
+        self.send(201, make_feed(server.sizes, n, 1, server=server.url))
+
+    def send_content(self, n):
+        """Send the range asked for of file n, or all of it if ranges are
+        off."""
+        size = self.server.sizes[n]
+        data = self.server.files.get(n)
+        get = content if data is None else lambda s, e: data[s:e]
+        r = self.headers.get('Range', '')
+        if not (self.server.ranges and r.startswith('bytes=')):
+            return self.send(200, get(0, size))
+        first, _, last = r[6:].partition('-')
+        start, end = int(first), min(int(last) + 1, size)
+        if start >= size:
+            return self.send(416, '')
+        self.send(206, get(start, end))
+
+    def send(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        step = 64 * 1024
+        t = time.time()
+        for pos in xrange(0, len(body), step):
+            self.wfile.write(body[pos:pos + step])
+            if bandwidth: # Keep to it, per response
+                delay = t + float(pos + step) / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        with self.server.lock:
+            self.server.sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeDrive(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server posing as Google Drive, with files of sizes.
+
+    File n is called filen and has resource id file:n. latency is in
+    seconds per request, bandwidth in bytes per second and response (0
+    for no limit). Unless ranges is set, Range headers are ignored and
+    whole files sent.
+
+    Uploads replace the content of a file, or add one at the end.
+
+    A failrate fraction of content requests and upload chunks get a 503,
+    and a slowrate fraction of content requests are held up slow seconds
+    more, for a tail."""
+    daemon_threads = True
+
+    def __init__(self, sizes, latency=0, bandwidth=0, ranges=True, port=0,
+                 failrate=0, slowrate=0, slow=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeDriveHandler)
+        self.sizes = sizes
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.failrate = failrate
+        self.slowrate = slowrate
+        self.slow = slow
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sent = 0 # Bytes of responses
+        self.files = {} # n -> uploaded content, instead of the pattern
+        self.sessions = {} # Upload id -> [n, chunks, bytes, size]
+
+    def start(self):
+        """Serve on a thread of its own."""
+        t = threading.Thread(target=self.serve_forever, name='fakedrive')
+        t.daemon = True
+        t.start()
+        return self
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='fakedrive')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=1024, metavar='KB',
+                        help='size of each file')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        metavar='MB/s', help='per response; 0 for no limit')
+    parser.add_argument('--ignore-range', action='store_true',
+                        help='send whole files, like a server without '
+                             'Range support')
+    parser.add_argument('--failrate', type=float, default=0,
+                        help='fraction of content requests and upload '
+                             'chunks to fail')
+    parser.add_argument('--slowrate', type=float, default=0,
+                        help='fraction of content requests to hold up')
+    parser.add_argument('--slow', type=float, default=1.0,
+                        help='seconds to hold them up for')
+    args = parser.parse_args()
+    drive = FakeDrive([args.size * 1024] * args.files, args.latency,
+                      args.bandwidth * 2**20, not args.ignore_range,
+                      args.port, args.failrate, args.slowrate, args.slow)
+    print 'Serving %d files on %s' % (args.files, drive.url)
+    drive.serve_forever()
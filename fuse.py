@@ -327,6 +327,16 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+_as_read_buffer = pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = (py_object, POINTER(c_void_p), POINTER(c_ssize_t))
+
+def read_buffer(obj):
+    """Returns the address and length of the data of a buffer object."""
+    addr, size = c_void_p(), c_ssize_t()
+    if _as_read_buffer(obj, byref(addr), byref(size)):
+        raise TypeError('%s has no buffer interface' % type(obj).__name__)
+    return addr.value, size.value
+
 def fuse_get_context():
     """Returns a (uid, gid, pid) tuple"""
     ctxp = _libfuse.fuse_get_context()
@@ -461,6 +471,9 @@ class FUSE(object):
         else:
             fi.fh = self.operations('open', path.decode(self.encoding),
                                             fi.flags)
+            if self.operations.direct_io and \
+                    self.operations.direct_io(path.decode(self.encoding)):
+                fi.direct_io = 1
 
             return 0
 
@@ -470,14 +483,28 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
+        if getattr(self.operations, 'readinto', None):
+            return self.operations('readinto', path.decode(self.encoding),
+                                               buf, size, offset, fh)
+
         ret = self.operations('read', path.decode(self.encoding), size,
                                       offset, fh)
 
         if not ret: return 0
 
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
-        return size
+        # Copy straight from the returned object, without slicing it.
+        if isinstance(ret, str):
+            addr, n = ret, len(ret)
+        else:
+            try:
+                addr, n = read_buffer(ret)
+            except TypeError:   # No old-style buffer, e.g. memoryview
+                ret = ret.tobytes() if hasattr(ret, 'tobytes') else str(ret)
+                addr, n = ret, len(ret)
+
+        n = min(n, size)
+        memmove(buf, addr, n)
+        return n
 
     def write(self, path, buf, size, offset, fip):
         data = string_at(buf, size)
@@ -764,9 +791,19 @@ class Operations(object):
         return 0
 
     def read(self, path, size, offset, fh):
-        """Returns a string containing the data requested."""
+        """Returns a string containing the data requested. A buffer or
+           other object supporting the buffer interface also works."""
         raise FuseOSError(EIO)
 
+    # If defined, readinto(path, buf, size, offset, fh) is called instead of
+    # read. buf is a ctypes pointer to size bytes, which the operation fills
+    # in itself, returning the number of bytes written.
+    readinto = None
+
+    # If defined, direct_io(path) is asked on each open whether reads of the
+    # file should bypass the page cache, e.g. for files of unknown size.
+    direct_io = None
+
     def readdir(self, path, fh):
         """Can return either a list of names, or a list of
            (name, attrs, offset) tuples. attrs is a dict as in getattr."""